@@ -0,0 +1,131 @@
+import os
+import warnings
+warnings.filterwarnings("ignore")
+import argparse
+import json
+import time
+import tempfile
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from param import to_valid_rgb, fft_image, dwt_image
+from utils import dev, slice_imgs, derivat, checkout, FrameWriter
+from interpol import interpolate
+import transforms
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s',  '--sizes',   default='256-256,512-512,1280-720,1920-1080', help='Resolutions, comma separated')
+    parser.add_argument(       '--samples', default='32,200', help='Cutout counts, comma separated')
+    parser.add_argument('-b',  '--batch',   default='1,8', help='Interpolated frames per render, comma separated')
+    parser.add_argument('-r',  '--repeat',  default=5, type=int, help='Timed runs per stage')
+    parser.add_argument('-o',  '--out',     default='bench.json', help='Output json file')
+    parser.add_argument(       '--device',  default='cpu', help='cuda, cpu, etc.')
+    parser.add_argument(       '--threads', default=0, type=int, help='CPU threads to use (0 = torch default)')
+    parser.add_argument(       '--modsize', default=224, type=int, help='Cutout size')
+    parser.add_argument(       '--stages',  default=None, help='Run only stages containing this substring')
+    a = parser.parse_args()
+    a.sizes = [[int(s) for s in size.split('-')][::-1] for size in a.sizes.split(',')]
+    a.samples = [int(s) for s in a.samples.split(',')]
+    a.batch = [int(s) for s in a.batch.split(',')]
+    return a
+
+class StubEncoder(nn.Module):
+    """ tiny stand-in for CLIP visual model, to time the pipeline without it """
+    def __init__(self, dim=512):
+        super(StubEncoder, self).__init__()
+        self.net = nn.Sequential(nn.Conv2d(3, 16, 7, stride=4), nn.ReLU(), nn.Conv2d(16, 32, 3, stride=2), nn.ReLU(),
+                                 nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(32, dim))
+    def encode_image(self, x):
+        return self.net(x)
+
+def timeit(fn, repeat=5, warmup=1):
+    for _ in range(warmup): fn()
+    dev.sync()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dev.sync()
+        times.append(time.perf_counter() - t0)
+    times = np.array(times) * 1000.
+    return {'ms_mean': float(times.mean()), 'ms_min': float(times.min()), 'ms_std': float(times.std())}
+
+def main():
+    a = get_args()
+    dev.set(a.device, a.threads)
+    tempdir = tempfile.mkdtemp()
+    model = dev.model(StubEncoder())
+    results = []
+
+    def bench(stage, fn, **info):
+        if a.stages is not None and a.stages not in stage: return
+        res = {'stage': stage, **info, **timeit(fn, a.repeat)}
+        results.append(res)
+        print(' %-28s %-12s %8.2f ms' % (stage, ' '.join(['%s=%s' % (k, v) for k, v in info.items()]), res['ms_mean']))
+
+    for size in a.sizes:
+        sz = '%d-%d' % (size[1], size[0])
+        shape = [1, 3, *size]
+        params, fft_f, _ = fft_image(list(shape), decay_power=1.5)
+        image_f = to_valid_rgb(fft_f, colors=1.5)
+        with torch.no_grad():
+            bench('fft_image.inner', lambda: fft_f(), size=sz)
+            bench('to_valid_rgb', lambda: image_f(), size=sz)
+        try:
+            _, dwt_f, _ = dwt_image(list(shape), 'coif2', 0.3, 1.5)
+            with torch.no_grad():
+                bench('dwt_image.inner', lambda: dwt_f(), size=sz)
+        except Exception as e:
+            print(' dwt_image skipped:', e)
+
+        with torch.no_grad():
+            img = image_f()
+        for mode in ['sobel', 'scharr', 'default']:
+            bench('derivat.%s' % mode, lambda: derivat(img, mode=mode), size=sz)
+        img_np = img.cpu().numpy()[0]
+        bench('checkout', lambda: checkout(img_np, os.path.join(tempdir, 'frame.jpg')), size=sz)
+        saver = FrameWriter()
+        bench('FrameWriter.put', lambda: saver.put(img[0], os.path.join(tempdir, 'frame.jpg')), size=sz)
+        saver.close()
+
+        params2 = params[0].detach() + torch.randn_like(params[0]) * 0.01
+        for batch in a.batch: # 16 frames
+            bench('interpol.interpolate', lambda: list(interpolate(params[0].detach(), params2, 16, 1.5, 1.5, batch=batch)), size=sz, batch=batch)
+
+        for samples in a.samples:
+            for align in ['uniform', 'overscan']:
+                with torch.no_grad():
+                    bench('slice_imgs.%s' % align, lambda: slice_imgs([img], samples, a.modsize, None, align, macro=0.4), size=sz, samples=samples)
+
+            def step():
+                img_out = image_f()
+                img_sliced = slice_imgs([img_out], samples, a.modsize, transforms.normalize(inplace=True), 'uniform', macro=0.4)[0]
+                loss = - dev.encode(model, img_sliced).mean() - 0.3 * derivat(img_out, mode='sobel')
+                params[0].grad = None
+                loss.backward()
+            bench('train.step', step, size=sz, samples=samples)
+
+    # transforms on cutouts
+    trforms = {'pad': transforms.pad(4, mode='constant', constant_value=0.5), 'jitter': transforms.jitter(8),
+               'random_scale': transforms.random_scale([1 + (i - 5) / 50. for i in range(11)]),
+               'random_rotate': transforms.random_rotate(list(range(-30, 30))), 'random_elastic': transforms.random_elastic(),
+               'normalize': transforms.normalize(), 'transforms_elastic': transforms.transforms_elastic,
+               'transforms_custom': transforms.transforms_custom, 'transforms_lucent': transforms.transforms_lucent,
+               'transforms_openai': transforms.transforms_openai}
+    for samples in a.samples:
+        crops = torch.rand(samples, 3, a.modsize, a.modsize, device=dev.device)
+        for name, trform in trforms.items():
+            with torch.no_grad():
+                bench('transforms.%s' % name, lambda: trform(crops), samples=samples)
+
+    info = {'torch': torch.__version__, 'device': str(dev.device), 'threads': torch.get_num_threads(), 'repeat': a.repeat}
+    with open(a.out, 'w') as f:
+        json.dump({'info': info, 'results': results}, f, indent=1)
+    print(' saved', a.out)
+
+
+if __name__ == '__main__':
+    main()
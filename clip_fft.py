@@ -1,27 +1,24 @@
 import os
 import warnings
+import contextlib
 warnings.filterwarnings("ignore")
 import argparse
-import numpy as np
-from imageio import imread, imsave
-import shutil
-from googletrans import Translator, constants
-
-import pywt
-from pytorch_wavelets import DWTForward, DWTInverse
-from pytorch_wavelets import DTCWTForward, DTCWTInverse
 
 import torch
-import torchvision
 import torch.nn.functional as F
 
 import clip
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
-from sentence_transformers import SentenceTransformer
-import lpips
 
-from utils import slice_imgs, derivat, basename, img_list, img_read, plot_text, txt_clean, checkout
+from utils import dev, autotune, micro_encode, recompute, slice_imgs, derivat, basename, img_read, plot_text, txt_clean, FrameWriter, VideoWriter, save_ckpt, load_ckpt
 import transforms
+# parametrizations are re-exported here for older imports (e.g. notebooks)
+from param import to_valid_rgb, color_matrix, spectrum_scale, fft_image, resume_fft, rfft2d_freqs, fft_level, res_levels, res_level, img2fft, un_rgb, un_spectrum, inv_sigmoid
+from param import dwt_image, init_dwt, dwt_scale, img2dwt, pixel_image
+from emb_cache import EmbCache
+from snapshot import save_snap, formats as snap_formats, codecs as snap_codecs
+from metrics import Metrics
+from targets import Targets
 try: # progress bar for notebooks 
     get_ipython().__class__.__name__
     from progress_bar import ProgressIPy as ProgressBar
@@ -30,7 +27,7 @@ except: # normal console
 
 clip_models = ['ViT-B/16', 'ViT-B/32', 'RN101', 'RN50x16', 'RN50x4', 'RN50']
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-i',  '--in_img',  default=None, help='input image')
     parser.add_argument('-t',  '--in_txt',  default=None, help='input text')
@@ -43,12 +40,29 @@ def get_args():
     parser.add_argument('-tr', '--translate', action='store_true', help='Translate text with Google Translate')
     parser.add_argument('-ml', '--multilang', action='store_true', help='Use SBERT multilanguage model for text')
     parser.add_argument(       '--save_pt', action='store_true', help='Save FFT snapshots for further use')
+    parser.add_argument(       '--snap_fmt', default='float32', choices=snap_formats, help='Snapshot precision: float32, float16 or q8 (8bit per frequency band)')
+    parser.add_argument(       '--snap_codec', default=None, choices=snap_codecs, help='Compress snapshots (needs zstandard or lz4)')
+    parser.add_argument(       '--frames',  action='store_true', help='Keep jpg frames (besides the video)')
+    parser.add_argument(       '--ckpt',    default=0, type=int, help='Save full checkpoint every N steps (and resume from it)')
+    parser.add_argument(       '--metrics', default=None, help='Save per-stage timings & memory to this jsonl/csv file')
+    parser.add_argument(       '--trace',   default=None, help='Save torch.profiler traces to this directory')
+    parser.add_argument(       '--emb_cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'aphantasia'), help='Embeddings cache directory ("" = memory only)')
     parser.add_argument('-v',  '--verbose', default=True, type=bool)
+    parser.add_argument(       '--device',  default=None, help='cuda, cpu, etc. (autodetect by default)')
+    parser.add_argument(       '--threads', default=0, type=int, help='CPU threads to use (0 = torch default)')
+    parser.add_argument(       '--bf16',    action='store_true', help='Use bfloat16 autocast for CLIP on CPU')
+    parser.add_argument(       '--mem_budget', default=0, type=float, help='Memory (GB) to keep cached between steps and to fit in with --autotune (0 = 90%% of the GPU, 80%% of RAM)')
+    parser.add_argument(       '--autotune', action='store_true', help='Probe speed & memory to set samples per micro-batch (instead of fixed per-model guesses)')
+    parser.add_argument(       '--step_time', default=0, type=float, help='Target step time (sec) for --autotune; fewer samples if needed (0 = no limit)')
+    parser.add_argument(       '--micro',   default=1, type=int, help='Encode cutouts in N micro-batches per step (less memory, same loss)')
+    parser.add_argument(       '--recompute', action='store_true', help='Activation checkpointing in the image encoder (less memory, slower)')
     # training
     parser.add_argument('-m',  '--model',   default='ViT-B/32', choices=clip_models, help='Select CLIP model to use')
     parser.add_argument(       '--steps',   default=200, type=int, help='Total iterations')
     parser.add_argument(       '--samples', default=200, type=int, help='Samples to evaluate')
     parser.add_argument(       '--lrate',   default=0.05, type=float, help='Learning rate')
+    parser.add_argument(       '--multires', default=1, type=int, help='Coarse-to-fine resolution levels (FFT only)')
+    parser.add_argument(       '--tile',    default=0, type=int, help='Render by strips of N rows, to save memory on huge sizes')
     parser.add_argument('-p',  '--prog',    action='store_true', help='Enable progressive lrate growth (up to double a.lrate)')
     # wavelet
     parser.add_argument(       '--dwt',     action='store_true', help='Use DWT instead of FFT')
@@ -66,312 +80,140 @@ def get_args():
     parser.add_argument('-nt', '--notext',  default=0, type=float, help='Subtract typed text as image (avoiding graffiti?), [0..1]')
     parser.add_argument('-c',  '--sync',    default=0, type=float, help='Sync output to input image')
     parser.add_argument(       '--invert',  action='store_true', help='Invert criteria')
-    a = parser.parse_args()
+    a = parser.parse_args(argv)
 
     if a.size is not None: a.size = [int(s) for s in a.size.split('-')][::-1]
     if len(a.size)==1: a.size = a.size * 2
     if a.in_img is not None and a.sync > 0: a.align = 'overscan'
+    if a.resume is not None: a.multires = 1 # coarse start would drop the resumed details
     if a.multilang is True: a.model = 'ViT-B/32' # sbert model is trained with ViT
     a.diverse = -a.enhance
     a.expand = abs(a.enhance)
     return a
 
-### FFT from Lucent library ###  https://github.com/greentfrapp/lucent
-
-def to_valid_rgb(image_f, colors=1., decorrelate=True):
-    color_correlation_svd_sqrt = np.asarray([[0.26, 0.09, 0.02],
-                                             [0.27, 0.00, -0.05],
-                                             [0.27, -0.09, 0.03]]).astype("float32")
-    color_correlation_svd_sqrt /= np.asarray([colors, 1., 1.]) # saturate, empirical
-    max_norm_svd_sqrt = np.max(np.linalg.norm(color_correlation_svd_sqrt, axis=0))
-    color_correlation_normalized = color_correlation_svd_sqrt / max_norm_svd_sqrt
-
-    def _linear_decorrelate_color(tensor):
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        t_permute = tensor.permute(0,2,3,1)
-        t_permute = torch.matmul(t_permute, torch.tensor(color_correlation_normalized.T).to(device))
-        tensor = t_permute.permute(0,3,1,2)
-        return tensor
-
-    def inner(*args, **kwargs):
-        image = image_f(*args, **kwargs)
-        if decorrelate:
-            image = _linear_decorrelate_color(image)
-        return torch.sigmoid(image)
-    return inner
-    
-def init_dwt(resume=None, shape=None, wave=None, colors=None):
-    size = None
-    wp_fake = pywt.WaveletPacket2D(data=np.zeros(shape[2:]), wavelet='db1', mode='symmetric')
-    xfm = DWTForward(J=wp_fake.maxlevel, wave=wave, mode='symmetric').cuda()
-    # xfm = DTCWTForward(J=lvl, biort='near_sym_b', qshift='qshift_b').cuda() # 4x more params, biort ['antonini','legall','near_sym_a','near_sym_b']
-    ifm = DWTInverse(wave=wave, mode='symmetric').cuda() # symmetric zero periodization
-    # ifm = DTCWTInverse(biort='near_sym_b', qshift='qshift_b').cuda() # 4x more params, biort ['antonini','legall','near_sym_a','near_sym_b']
-    if resume is None: # random init
-        Yl_in, Yh_in = xfm(torch.zeros(shape).cuda())
-        Ys = [torch.randn(*Y.shape).cuda() for Y in [Yl_in, *Yh_in]]
-    elif isinstance(resume, str):
-        if os.path.isfile(resume):
-            if os.path.splitext(resume)[1].lower()[1:] in ['jpg','png','tif','bmp']:
-                img_in = imread(resume)
-                Ys = img2dwt(img_in, wave=wave, colors=colors)
-                print(' loaded image', resume, img_in.shape, 'level', len(Ys)-1)
-                size = img_in.shape[:2]
-                wp_fake = pywt.WaveletPacket2D(data=np.zeros(size), wavelet='db1', mode='symmetric')
-                xfm = DWTForward(J=wp_fake.maxlevel, wave=wave, mode='symmetric').cuda()
-            else:
-                Ys = torch.load(resume)
-                Ys = [y.detach().cuda() for y in Ys]
-        else: print(' Snapshot not found:', resume); exit()
-    else:
-        Ys = [y.cuda() for y in resume]
-    # print('level', len(Ys)-1, 'low freq', Ys[0].cpu().numpy().shape)
-    return Ys, xfm, ifm, size
-
-def dwt_image(shape, wave='coif2', sharp=0.3, colors=1., resume=None):
-    Ys, _, ifm, size = init_dwt(resume, shape, wave, colors)
-    Ys = [y.requires_grad_(True) for y in Ys]
-    scale = dwt_scale(Ys, sharp)
-
-    def inner(shift=None, contrast=1.):
-        image = ifm((Ys[0], [Ys[i+1] * float(scale[i]) for i in range(len(Ys)-1)]))
-        image = image * contrast / image.std() # keep contrast, empirical *1.33
-        return image
-
-    return Ys, inner, size
-
-def dwt_scale(Ys, sharp):
-    scale = []
-    [h0,w0] = Ys[1].shape[3:5]
-    for i in range(len(Ys)-1):
-        [h,w] = Ys[i+1].shape[3:5]
-        scale.append( ((h0*w0)/(h*w)) ** (1.-sharp) )
-        # print(i+1, Ys[i+1].shape)
-    return scale
-
-def img2dwt(img_in, wave='coif2', sharp=0.3, colors=1.):
-    if not isinstance(img_in, torch.Tensor):
-        img_in = torch.Tensor(img_in).cuda().permute(2,0,1).unsqueeze(0).float() / 255.
-    img_in = un_rgb(img_in, colors=colors)
-    with torch.no_grad():
-        wp_fake = pywt.WaveletPacket2D(data=np.zeros(img_in.shape[2:]), wavelet='db1', mode='zero')
-        lvl = wp_fake.maxlevel
-        # print(img_in.shape, lvl)
-        xfm = DWTForward(J=lvl, wave=wave, mode='symmetric').cuda()
-        Yl_in, Yh_in = xfm(img_in.cuda())
-        Ys = [Yl_in, *Yh_in]
-    scale = dwt_scale(Ys, sharp)
-    for i in range(len(Ys)-1):
-        Ys[i+1] /= scale[i]
-    return Ys
-
-def pixel_image(shape, resume=None, sd=1., *noargs, **nokwargs):
-    size = None
-    if resume is None:
-        tensor = torch.randn(*shape) * sd
-    elif isinstance(resume, str):
-        if os.path.isfile(resume):
-            img_in = imread(resume) / 255.
-            tensor = torch.Tensor(img_in).permute(2,0,1).unsqueeze(0).float()
-            tensor = un_rgb(tensor-0.5, colors=2.) # experimental
-            size = img_in.shape[:2]
-            print(resume, size)
-        else: print(' Image not found:', resume); exit()
-    else:
-        if isinstance(resume, list): resume = resume[0]
-        tensor = resume
-    tensor = tensor.cuda().requires_grad_(True)
-
-    def inner(shift=None, contrast=1.): # *noargs, **nokwargs
-        image = tensor * contrast / tensor.std()
-        return image
-    return [tensor], inner, size # lambda: tensor
-
-# From https://github.com/tensorflow/lucid/blob/master/lucid/optvis/param/spatial.py
-def rfft2d_freqs(h, w):
-    """Computes 2D spectrum frequencies."""
-    fy = np.fft.fftfreq(h)[:, None]
-    # when we have an odd input dimension we need to keep one additional frequency and later cut off 1 pixel
-    w2 = (w+1)//2 if w%2 == 1 else w//2+1
-    fx = np.fft.fftfreq(w)[:w2]
-    return np.sqrt(fx * fx + fy * fy)
-
-def resume_fft(resume=None, shape=None, decay=None, colors=1.6, sd=0.01):
-    size = None
-    if resume is None: # random init
-        params_shape = [*shape[:3], shape[3]//2+1, 2] # [1,3,512,257,2] for 512x512 (2 for imaginary and real components)
-        params = 0.01 * torch.randn(*params_shape).cuda()
-    elif isinstance(resume, str):
-        if os.path.isfile(resume):
-            if os.path.splitext(resume)[1].lower()[1:] in ['jpg','png','tif','bmp']:
-                img_in = imread(resume)
-                params = img2fft(img_in, decay, colors)
-                size = img_in.shape[:2]
-            else:
-                params = torch.load(resume)
-                if isinstance(params, list): params = params[0]
-                params = params.detach().cuda()
-            params *= sd
-        else: print(' Snapshot not found:', resume); exit()
-    else:
-        if isinstance(resume, list): resume = resume[0]
-        params = resume.cuda()
-    return params, size
-
-def fft_image(shape, sd=0.01, decay_power=1.0, resume=None): # decay ~ blur
-
-    params, size = resume_fft(resume, shape, decay_power, sd=sd)
-    spectrum_real_imag_t = params.requires_grad_(True)
-    if size is not None: shape[2:] = size
-    [h,w] = list(shape[2:])
-
-    freqs = rfft2d_freqs(h,w)
-    scale = 1. / np.maximum(freqs, 4./max(h,w)) ** decay_power
-    scale *= np.sqrt(h*w)
-    scale = torch.tensor(scale).float()[None, None, ..., None].cuda()
-
-    def inner(shift=None, contrast=1.):
-        scaled_spectrum_t = scale * spectrum_real_imag_t
-        if shift is not None:
-            scaled_spectrum_t += scale * shift
-        if float(torch.__version__[:3]) < 1.8:
-            image = torch.irfft(scaled_spectrum_t, 2, normalized=True, signal_sizes=(h, w))
-        else:
-            if type(scaled_spectrum_t) is not torch.complex64:
-                scaled_spectrum_t = torch.view_as_complex(scaled_spectrum_t)
-            image = torch.fft.irfftn(scaled_spectrum_t, s=(h, w), norm='ortho')
-        image = image * contrast / image.std() # keep contrast, empirical
-        return image
-
-    return [spectrum_real_imag_t], inner, size
-
-def inv_sigmoid(x):
-    eps = 1.e-12
-    x = torch.clamp(x.double(), eps, 1-eps)
-    y = torch.log(x/(1-x))
-    return y.float()
-
-def un_rgb(image, colors=1.):
-    color_correlation_svd_sqrt = np.asarray([[0.26, 0.09, 0.02], [0.27, 0.00, -0.05], [0.27, -0.09, 0.03]]).astype("float32")
-    color_correlation_svd_sqrt /= np.asarray([colors, 1., 1.])
-    max_norm_svd_sqrt = np.max(np.linalg.norm(color_correlation_svd_sqrt, axis=0))
-    color_correlation_normalized = color_correlation_svd_sqrt / max_norm_svd_sqrt
-    color_uncorrelate = np.linalg.inv(color_correlation_normalized)
-
-    image = inv_sigmoid(image)
-    t_permute = image.permute(0,2,3,1)
-    t_permute = torch.matmul(t_permute, torch.tensor(color_uncorrelate.T).cuda())
-    image = t_permute.permute(0,3,1,2)
-    return image
-
-def un_spectrum(spectrum, decay_power):
-    h = spectrum.shape[2]
-    w = (spectrum.shape[3]-1)*2
-    freqs = rfft2d_freqs(h, w)
-    scale = 1.0 / np.maximum(freqs, 1.0 / max(w, h)) ** decay_power
-    scale *= np.sqrt(w*h)
-    scale = torch.tensor(scale).float()[None, None, ..., None].cuda()
-    return spectrum / scale
-
-def img2fft(img_in, decay=1., colors=1.):
-    h, w = img_in.shape[0], img_in.shape[1]
-    img_in = torch.Tensor(img_in).cuda().permute(2,0,1).unsqueeze(0) / 255.
-    img_in = un_rgb(img_in, colors=colors)
-
-    with torch.no_grad():
-        if float(torch.__version__[:3]) < 1.8:
-            spectrum = torch.rfft(img_in, 2, normalized=True) # 1.7
-        else:
-            spectrum = torch.fft.rfftn(img_in, s=(h, w), dim=[2,3], norm='ortho') # 1.8
-            spectrum = torch.view_as_real(spectrum)
-        spectrum = un_spectrum(spectrum, decay_power=decay)
-        spectrum *= 500000. # [sic!!!]
-    return spectrum
-
-
-def main():
-    a = get_args()
+def main(a=None, callback=None):
+    """ callback(**event) gets the progress per saved frame, e.g. from server.py """
+    if a is None: a = get_args()
+    dev.set(a.device, a.threads, a.bf16)
 
     prev_enc = 0
     def train(i):
-        loss = 0
-        
-        noise = a.noise * torch.rand(1, 1, *params[0].shape[2:4], 1).cuda() if a.noise > 0 else None
-        img_out = image_f(noise)
-        img_sliced = slice_imgs([img_out], a.samples, a.modsize, trform_f, a.align, macro=a.macro)[0]
-        out_enc = model_clip.encode_image(img_sliced)
-
-        if a.in_txt is not None: # input text
-            loss +=  sign * torch.cosine_similarity(txt_enc, out_enc, dim=-1).mean()
-            if a.notext > 0:
-                loss -= sign * a.notext * torch.cosine_similarity(txt_plot_enc, out_enc, dim=-1).mean()
-        if a.in_txt2 is not None: # input text - style
-            loss +=  sign * 0.5 * torch.cosine_similarity(txt_enc2, out_enc, dim=-1).mean()
-        if a.in_txt0 is not None: # subtract text
-            loss += -sign * torch.cosine_similarity(txt_enc0, out_enc, dim=-1).mean()
-        if a.in_img is not None and os.path.isfile(a.in_img): # input image
-            loss +=  sign * 0.5 * torch.cosine_similarity(img_enc, out_enc, dim=-1).mean()
-        if a.sync > 0 and a.in_img is not None and os.path.isfile(a.in_img): # image composition
-            prog_sync = (a.steps // a.fstep - i) / (a.steps // a.fstep)
-            loss += prog_sync * a.sync * sim_loss(F.interpolate(img_out, sim_size).float(), img_in, normalize=True).squeeze()
-        if a.sharp != 0 and a.dwt is not True: # scharr|sobel|default
-            loss -= a.sharp * derivat(img_out, mode='sobel')
-            # loss -= a.sharp * derivat(img_sliced, mode='scharr')
-        if a.diverse != 0:
-            img_sliced = slice_imgs([image_f(noise)], a.samples, a.modsize, trform_f, a.align, macro=a.macro)[0]
-            out_enc2 = model_clip.encode_image(img_sliced)
-            loss += a.diverse * torch.cosine_similarity(out_enc, out_enc2, dim=-1).mean()
-            del out_enc2; torch.cuda.empty_cache()
-        if a.expand > 0:
-            global prev_enc
-            if i > 0:
-                loss += a.expand * torch.cosine_similarity(out_enc, prev_enc, dim=-1).mean()
-            prev_enc = out_enc.detach()
-
-        del img_out, img_sliced, out_enc; torch.cuda.empty_cache()
-        assert not isinstance(loss, int), ' Loss not defined, check the inputs'
-        
         if a.prog is True:
             lr_cur = lr0 + (i / a.steps) * (lr1 - lr0)
             for g in optimizer.param_groups: 
                 g['lr'] = lr_cur
-    
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+
+        encs = []
+        targets.reset()
+        def enc_loss(out_enc, idx): # terms on encodings [1,n,dim], averaged over samples
+            pairs = [] # per-sample terms, besides the fixed targets
+            if a.diverse != 0:
+                out_enc, out_enc2 = out_enc.chunk(2, dim=1)
+                pairs.append(('diverse', a.diverse, out_enc2))
+            if a.in_img is not None and os.path.isfile(a.in_img): # input image, paired per sample (cycled if counts differ)
+                img_idx = torch.arange(idx.start, idx.stop, device=img_enc.device) % img_enc.shape[0]
+                pairs.append(('img', sign * 0.5, img_enc[img_idx][None]))
+            if a.expand > 0:
+                if i > step0:
+                    pairs.append(('expand', a.expand, prev_enc[:, idx]))
+                encs.append(out_enc.detach())
+            loss = targets(out_enc, pairs)
+            assert not isinstance(loss, int), ' Loss not defined, check the inputs'
+            return loss
+
+        with mtr.stage('param'):
+            noise = dev.buffer('noise', [1, 1, *params[0].shape[2:4], 1]).uniform_(0, a.noise) if a.noise > 0 else None
+            img_out = image_f(noise)
+        cuts = 2 if a.diverse != 0 else 1 # second set of samples for diversity, from the same render
+        with mtr.stage('slice'): # with augmentation
+            img_sliced = slice_imgs([img_out], a.samples * cuts, a.modsize, trform_f, a.align, macro=a.macro)[0]
+        # encoder passes in micro-batches, down to the cutouts
+        loss, grad = micro_encode(model_clip, img_sliced, enc_loss, a.micro, 1, cuts, mtr.stage)
+        if a.expand > 0:
+            nonlocal prev_enc
+            prev_enc = torch.cat(encs, 1)
+
+        with mtr.stage('loss'):
+            img_loss = 0 # terms on the whole image
+            if a.sync > 0 and a.in_img is not None and os.path.isfile(a.in_img): # image composition
+                prog_sync = (a.steps // a.fstep - i) / (a.steps // a.fstep)
+                img_loss += prog_sync * a.sync * sim_loss(F.interpolate(img_out, sim_size).float(), img_in, normalize=True).squeeze()
+            if a.sharp != 0 and a.dwt is not True: # scharr|sobel|default
+                img_loss -= a.sharp * derivat(img_out, mode='sobel')
+                # img_loss -= a.sharp * derivat(img_sliced, mode='scharr')
+
+        with mtr.stage('backward'):
+            optimizer.zero_grad(set_to_none=True)
+            if isinstance(img_loss, int):
+                img_sliced.backward(grad)
+            else:
+                torch.autograd.backward([img_sliced, img_loss], [grad, None])
+        del img_out, img_sliced, grad
+        with mtr.stage('optim'):
+            optimizer.step()
 
         if i % a.fstep == 0:
-            with torch.no_grad():
-                img = image_f(contrast=a.contrast).cpu().numpy()[0]
-            # empirical tone mapping
-            if (a.sync > 0 and a.in_img is not None):
-                img = img **1.3
-            elif a.sharp != 0:
-                img = img ** (1 + a.sharp/2.)
-            checkout(img, os.path.join(tempdir, '%04d.jpg' % (i // a.fstep)), verbose=a.verbose)
+            with mtr.stage('output'):
+                with torch.no_grad():
+                    img = image_f(contrast=a.contrast)
+                    if list(img.shape[2:]) != list(a.size): # coarse level
+                        img = F.interpolate(img, a.size, mode='bilinear', align_corners=False)
+                    img = img[0]
+                    # empirical tone mapping
+                    if (a.sync > 0 and a.in_img is not None):
+                        img = img **1.3
+                    elif a.sharp != 0:
+                        img = img ** (1 + a.sharp/2.)
+                saver.put(img, os.path.join(tempdir, '%04d.jpg' % (i // a.fstep)) if a.frames else None, video)
+                if i + a.fstep >= a.steps: # last frame
+                    saver.put(img, os.path.join(a.out_dir, '%s-%d.jpg' % (out_name, a.steps)), show=False)
             pbar.upd()
+            if callback is not None:
+                callback(step=i, steps=a.steps, loss=float(loss + img_loss), terms=targets.values(), frames=[os.path.join(tempdir, '%04d.jpg' % (i // a.fstep))] if a.frames else None)
+
+        if a.ckpt > 0 and (i+1) % a.ckpt == 0:
+            save_ckpt(ckpt_file, {'step': i, 'params': [p.detach() for p in params], 'optim': optimizer.state_dict()})
+        dev.trim(a.mem_budget)
+        mtr.step(i, **(targets.values() if mtr.enabled else {}))
 
     # Load CLIP models
     use_jit = True if float(torch.__version__[:3]) < 1.8 else False
-    model_clip, _ = clip.load(a.model, jit=use_jit)
+    def load_clip():
+        model_clip, _ = clip.load(a.model, device=dev.device, jit=use_jit)
+        return dev.model(model_clip).requires_grad_(False) # grads are needed for the inputs only
+    model_clip = dev.load(('clip', a.model, use_jit), load_clip)
+    recompute(model_clip, a.recompute)
     try:
         a.modsize = model_clip.visual.input_resolution 
     except:
         a.modsize = 288 if a.model == 'RN50x4' else 384 if a.model == 'RN50x16' else 224
     if a.verbose is True: print(' using model', a.model)
+    samples = a.samples # as requested, for autotune
     xmem = {'ViT-B/16':0.25, 'RN50':0.5, 'RN50x4':0.16, 'RN50x16':0.06, 'RN101':0.33}
     if a.model in xmem.keys():
         a.samples = int(a.samples * xmem[a.model])
             
-    if a.multilang is True:
-        model_lang = SentenceTransformer('clip-ViT-B-32-multilingual-v1').cuda()
+    embs = EmbCache(a.emb_cache)
+    model_lang = None
 
     def enc_text(txt):
-        if a.multilang is True:
-            emb = model_lang.encode([txt], convert_to_tensor=True, show_progress_bar=False)
-        else:
-            emb = model_clip.encode_text(clip.tokenize(txt).cuda())
-        return emb.detach().clone()
+        def calc():
+            nonlocal model_lang
+            if a.multilang is True:
+                if model_lang is None: # loaded only if not cached
+                    from sentence_transformers import SentenceTransformer
+                    model_lang = dev.load(('sbert',), lambda: SentenceTransformer('clip-ViT-B-32-multilingual-v1').to(dev.device))
+                emb = model_lang.encode([txt], convert_to_tensor=True, show_progress_bar=False, device=dev.device)
+            else:
+                emb = model_clip.encode_text(clip.tokenize(txt).to(dev.device))
+            return emb.detach().clone()
+        return embs.get(embs.key(a.model, txt, a.multilang), calc, dev.device)
+
+    def enc_plot(txt):
+        def calc():
+            txt_plot = torch.from_numpy(plot_text(txt, a.modsize)/255.).unsqueeze(0).permute(0,3,1,2).to(dev.device)
+            return dev.encode(model_clip, txt_plot).detach().clone()
+        return embs.get(embs.key(a.model, txt, False, 'plot', a.modsize), calc, dev.device)
     
     if a.diverse != 0:
         a.samples = int(a.samples * 0.5)
@@ -383,12 +225,13 @@ def main():
         trform_f = transforms.transforms_elastic
         a.samples = int(a.samples * 0.95)
     else:
-        trform_f = transforms.normalize()
+        trform_f = transforms.normalize(inplace=True)
 
     out_name = []
     if a.in_txt is not None:
         if a.verbose is True: print(' topic text: ', basename(a.in_txt))
         if a.translate:
+            from googletrans import Translator
             translator = Translator()
             a.in_txt = translator.translate(a.in_txt, dest='en').text
             if a.verbose is True: print(' translated to:', a.in_txt) 
@@ -396,13 +239,13 @@ def main():
         out_name.append(txt_clean(a.in_txt))
 
         if a.notext > 0:
-            txt_plot = torch.from_numpy(plot_text(a.in_txt, a.modsize)/255.).unsqueeze(0).permute(0,3,1,2).cuda()
-            txt_plot_enc = model_clip.encode_image(txt_plot).detach().clone()
+            txt_plot_enc = enc_plot(a.in_txt)
 
     if a.in_txt2 is not None:
         if a.verbose is True: print(' style text:', basename(a.in_txt2))
         a.samples = int(a.samples * 0.75)
         if a.translate:
+            from googletrans import Translator
             translator = Translator()
             a.in_txt2 = translator.translate(a.in_txt2, dest='en').text
             if a.verbose is True: print(' translated to:', a.in_txt2) 
@@ -413,36 +256,46 @@ def main():
         if a.verbose is True: print(' subtract text:', basename(a.in_txt0))
         a.samples = int(a.samples * 0.75)
         if a.translate:
+            from googletrans import Translator
             translator = Translator()
             a.in_txt0 = translator.translate(a.in_txt0, dest='en').text
             if a.verbose is True: print(' translated to:', a.in_txt0) 
         txt_enc0 = enc_text(a.in_txt0)
         out_name.append('off-' + txt_clean(a.in_txt0))
 
-    if a.multilang is True: del model_lang
+    model_lang = None
 
     if a.in_img is not None and os.path.isfile(a.in_img):
         if a.verbose is True: print(' ref image:', basename(a.in_img))
-        img_in = torch.from_numpy(img_read(a.in_img)/255.).unsqueeze(0).permute(0,3,1,2).cuda()
+        img_np = img_read(a.in_img)
+        img_in = torch.from_numpy(img_np/255.).unsqueeze(0).permute(0,3,1,2).to(dev.device)
         img_in = img_in[:,:3,:,:] # fix rgb channels
-        in_sliced = slice_imgs([img_in], a.samples, a.modsize, transforms.normalize(), a.align)[0]
-        img_enc = model_clip.encode_image(in_sliced).detach().clone()
+        def calc():
+            in_sliced = slice_imgs([img_in], a.samples, a.modsize, transforms.normalize(inplace=True), a.align)[0]
+            return dev.encode(model_clip, in_sliced).detach().clone()
+        img_enc = embs.get(embs.key(a.model, img_np, False, 'img', a.samples, a.align), calc, dev.device)
         if a.sync > 0:
-            sim_loss = lpips.LPIPS(net='vgg', verbose=False).cuda()
+            import lpips
+            sim_loss = dev.load(('lpips', 'vgg'), lambda: lpips.LPIPS(net='vgg', verbose=False).to(dev.device))
             sim_size = [s//2 for s in a.size]
             img_in = F.interpolate(img_in, sim_size).float()
         else:
             del img_in
-        del in_sliced; torch.cuda.empty_cache()
+        torch.cuda.empty_cache()
         out_name.append(basename(a.in_img).replace(' ', '_'))
 
     shape = [1, 3, *a.size]
+    sparse = a.sharp == 0 and not (a.sync > 0 and a.in_img is not None) # with --tile, skip strips without gradient only if no whole-image loss
     if a.dwt is True:
         params, image_f, sz = dwt_image(shape, a.wave, a.sharp, a.colors, a.resume)
     else:
-        params, image_f, sz = fft_image(shape, 0.01, a.decay, a.resume)
+        params, image_f, sz = fft_image(shape, 0.01, a.decay, a.resume, tile=a.tile, sparse=sparse)
     if sz is not None: a.size = sz
-    image_f = to_valid_rgb(image_f, colors = a.colors)
+    image_f = to_valid_rgb(image_f, colors = a.colors, tile=a.tile, sparse=sparse)
+    if a.dwt is True: a.multires = 1
+    levels, lvl = res_levels(a.size, a.multires, a.modsize), 0 # not smaller than the cutouts
+    if a.multires > 1: # start from the coarsest level
+        params, image_f = fft_level(params, None, levels[lvl], a.decay, a.colors, a.tile, sparse)
 
     if a.prog is True:
         lr1 = a.lrate * 2
@@ -451,21 +304,69 @@ def main():
         lr0 = a.lrate
     optimizer = torch.optim.AdamW(params, lr0, weight_decay=0.01, amsgrad=True)
     sign = 1. if a.invert is True else -1.
-
-    if a.verbose is True: print(' samples:', a.samples)
+    targets = Targets() # fixed targets, in one matmul
+    if a.in_txt is not None: # input text
+        targets.add('txt', txt_enc, sign)
+        if a.notext > 0:
+            targets.add('notext', txt_plot_enc, -sign * a.notext)
+    if a.in_txt2 is not None: # input text - style
+        targets.add('txt2', txt_enc2, sign * 0.5)
+    if a.in_txt0 is not None: # subtract text
+        targets.add('txt0', txt_enc0, -sign)
+
+    if a.autotune is True: # instead of the guesses above; on a full-size image with --multires
+        cuts = 2 if a.diverse != 0 else 1
+        params_tmp, image_tmp = params, image_f
+        if a.multires > 1:
+            params_tmp, image_tmp, _ = fft_image([1, 3, *levels[-1]], decay_power=a.decay, tile=a.tile, sparse=sparse)
+            image_tmp = to_valid_rgb(image_tmp, colors = a.colors, tile=a.tile, sparse=sparse)
+        def probe(n): # forward & backward on n samples, no update
+            img_sliced = slice_imgs([image_tmp()], n * cuts, a.modsize, trform_f, a.align, macro=a.macro)[0]
+            dev.encode(model_clip, img_sliced).mean().backward()
+            for p in params_tmp: p.grad = None
+        per_micro, a.micro = autotune(probe, samples, a.mem_budget, a.step_time, verbose=a.verbose)
+        a.samples = per_micro * a.micro
+        del params_tmp, image_tmp
+    if a.verbose is True: print(' samples:', a.samples if a.micro == 1 else '%d in %d micro-batches' % (a.samples, a.micro))
     out_name = '-'.join(out_name)
     out_name += '-%s' % a.model if 'RN' in a.model.upper() else ''
     tempdir = os.path.join(a.out_dir, out_name)
-    os.makedirs(tempdir, exist_ok=True)
-
-    pbar = ProgressBar(a.steps // a.fstep)
-    for i in range(a.steps):
-        train(i)
+    os.makedirs(tempdir if a.frames else a.out_dir, exist_ok=True)
+
+    step0 = 0
+    ckpt_file = '%s.ckpt' % os.path.join(a.out_dir, out_name)
+    ckpt = load_ckpt(ckpt_file) if a.ckpt > 0 else None
+    if ckpt is not None:
+        if res_level(ckpt['step'], a.steps, a.multires) > lvl:
+            lvl = res_level(ckpt['step'], a.steps, a.multires)
+            params, image_f = fft_level(params, optimizer, levels[lvl], a.decay, a.colors, a.tile, sparse)
+        for p, p_saved in zip(params, ckpt['params']):
+            p.data.copy_(p_saved)
+        optimizer.load_state_dict(ckpt['optim'])
+        step0 = ckpt['step'] + 1
+        if a.verbose is True: print(' resumed from checkpoint, step', step0)
+    # after resume, frames go to a separate segment (the finished part stays as is)
+    video = VideoWriter('%s.mp4' % os.path.join(a.out_dir, out_name if step0 == 0 else '%s-from%d' % (out_name, step0)))
+
+    with contextlib.ExitStack() as stack: # closed in reverse order, also on errors (server jobs): writer threads, encoder, profiler
+        stack.callback(video.close)
+        mtr = Metrics(a.metrics, a.trace, name=out_name)
+        stack.callback(mtr.close)
+        saver = FrameWriter(verbose=a.verbose)
+        stack.callback(saver.close)
+        pbar = ProgressBar(a.steps // a.fstep - step0 // a.fstep)
+        for i in range(step0, a.steps):
+            if res_level(i, a.steps, a.multires) > lvl: # coarse-to-fine
+                lvl = res_level(i, a.steps, a.multires)
+                params, image_f = fft_level(params, optimizer, levels[lvl], a.decay, a.colors, a.tile, sparse)
+            train(i)
+        mtr.summary()
+    if a.ckpt > 0 and os.path.isfile(ckpt_file):
+        os.remove(ckpt_file)
 
-    os.system('ffmpeg -v warning -y -i %s\%%04d.jpg "%s.mp4"' % (tempdir, os.path.join(a.out_dir, out_name)))
-    shutil.copy(img_list(tempdir)[-1], os.path.join(a.out_dir, '%s-%d.jpg' % (out_name, a.steps)))
     if a.save_pt is True:
-        torch.save(params, '%s.pt' % os.path.join(a.out_dir, out_name))
+        save_snap('%s.pt' % os.path.join(a.out_dir, out_name), params, a.snap_fmt, a.snap_codec, None if a.dwt is True else a.decay)
+    return video.fname
 
 if __name__ == '__main__':
     main()
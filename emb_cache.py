@@ -0,0 +1,55 @@
+"""
+from emb_cache import EmbCache
+
+embs = EmbCache('_cache')
+emb = embs.get(embs.key(model_name, text), lambda: encode(text), device)
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+import torch
+
+class EmbCache(object):
+    '''Embeddings store: in-memory LRU on top of .npy files on disk
+    '''
+    def __init__(self, cache_dir=None, size=1024):
+        self.dir = cache_dir if cache_dir else None
+        if self.dir is not None:
+            os.makedirs(self.dir, exist_ok=True)
+        self.size = size
+        self.mem = OrderedDict()
+
+    def key(self, model, data, multilang=False, *extra):
+        # data: text string or image array (hashed by content)
+        h = hashlib.sha1()
+        for x in [model, multilang, *extra]:
+            h.update(str(x).encode('utf-8') + b'\0')
+        if isinstance(data, str):
+            h.update(data.encode('utf-8'))
+        else:
+            data = np.ascontiguousarray(data)
+            h.update(str(data.shape).encode('utf-8') + data.tobytes())
+        return h.hexdigest()
+
+    def get(self, key, calc, device=None):
+        if key in self.mem:
+            self.mem.move_to_end(key)
+            return self.mem[key]
+        path = None if self.dir is None else os.path.join(self.dir, key + '.npy')
+        if path is not None and os.path.isfile(path):
+            emb = torch.from_numpy(np.load(path)) # small, read at once
+        else:
+            emb = calc().detach()
+            if path is not None: # atomic write, temp file per process (parallel workers)
+                tmp = '%s.%d.tmp.npy' % (path, os.getpid())
+                np.save(tmp, emb.cpu().numpy())
+                os.replace(tmp, path)
+        if device is not None: emb = emb.to(device)
+        self.mem[key] = emb
+        if len(self.mem) > self.size:
+            self.mem.popitem(last=False)
+        return emb
+
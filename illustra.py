@@ -1,22 +1,22 @@
 import os
 import argparse
-import math
-import numpy as np
+import contextlib
 import shutil
-from imageio import imsave
-from googletrans import Translator, constants
 
 import torch
-import torchvision
 import torch.nn.functional as F
 
 import clip
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
-from sentence_transformers import SentenceTransformer
 
-from clip_fft import to_valid_rgb, fft_image
-from utils import slice_imgs, derivat, checkout, cvshow, pad_up_to, basename, file_list, img_list, img_read, txt_clean, plot_text
+from param import to_valid_rgb, fft_image, fft_level, res_levels, res_level
+from interpol import interpolate
+from utils import dev, autotune, micro_encode, recompute, slice_imgs, derivat, FrameWriter, VideoWriter, save_ckpt, load_ckpt, pad_up_to, basename, file_list, img_read, txt_clean, plot_text
 import transforms
+from emb_cache import EmbCache
+from snapshot import save_snap, load_snap, keyframes, formats as snap_formats, codecs as snap_codecs
+from metrics import Metrics
+from targets import Targets
 try: # progress bar for notebooks 
     get_ipython().__class__.__name__
     from progress_bar import ProgressIPy as ProgressBar
@@ -25,7 +25,7 @@ except: # normal console
 
 clip_models = ['ViT-B/16', 'ViT-B/32', 'RN101', 'RN50x16', 'RN50x4', 'RN50']
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-i',  '--in_txt',  default=None, help='Text file to process')
     parser.add_argument('-t2', '--in_txt2', default=None, help='input text - style')
@@ -38,18 +38,36 @@ def get_args():
     parser.add_argument('-tr', '--translate', action='store_true', help='Translate text with Google Translate')
     parser.add_argument('-ml', '--multilang', action='store_true', help='Use SBERT multilanguage model for text')
     parser.add_argument(       '--save_pt', action='store_true', help='Save FFT snapshots for further use')
+    parser.add_argument(       '--snap_fmt', default='float32', choices=snap_formats, help='Snapshot precision: float32, float16 or q8 (8bit per frequency band)')
+    parser.add_argument(       '--snap_codec', default=None, choices=snap_codecs, help='Compress snapshots (needs zstandard or lz4)')
+    parser.add_argument(       '--frames',  action='store_true', help='Keep jpg frames (besides the video)')
+    parser.add_argument(       '--ckpt',    default=0, type=int, help='Save full checkpoint every N steps (resumed automatically)')
+    parser.add_argument(       '--metrics', default=None, help='Save per-stage timings & memory to this jsonl/csv file')
+    parser.add_argument(       '--trace',   default=None, help='Save torch.profiler traces to this directory')
+    parser.add_argument(       '--emb_cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'aphantasia'), help='Embeddings cache directory ("" = memory only)')
     parser.add_argument(       '--fps',     default=25, type=int)
     parser.add_argument('-v',  '--verbose', default=True, type=bool)
+    parser.add_argument(       '--device',  default=None, help='cuda, cpu, etc. (autodetect by default)')
+    parser.add_argument(       '--threads', default=0, type=int, help='CPU threads to use (0 = torch default)')
+    parser.add_argument(       '--bf16',    action='store_true', help='Use bfloat16 autocast for CLIP on CPU')
+    parser.add_argument(       '--mem_budget', default=0, type=float, help='Memory (GB) to keep cached between steps and to fit in with --autotune (0 = 90%% of the GPU, 80%% of RAM)')
+    parser.add_argument(       '--autotune', action='store_true', help='Probe speed & memory to set samples per micro-batch (instead of fixed per-model guesses)')
+    parser.add_argument(       '--step_time', default=0, type=float, help='Target step time (sec) for --autotune; fewer samples if needed (0 = no limit)')
+    parser.add_argument(       '--micro',   default=1, type=int, help='Encode cutouts in N micro-batches per step (less memory, same loss)')
+    parser.add_argument(       '--recompute', action='store_true', help='Activation checkpointing in the image encoder (less memory, slower)')
     # training
     parser.add_argument('-m',  '--model',   default='ViT-B/32', choices=clip_models, help='Select CLIP model to use')
     parser.add_argument(       '--steps',   default=200, type=int, help='Total iterations')
     parser.add_argument(       '--samples', default=200, type=int, help='Samples to evaluate')
     parser.add_argument('-lr', '--lrate',   default=0.05, type=float, help='Learning rate')
     parser.add_argument('-p',  '--prog',    action='store_true', help='Enable progressive lrate growth (up to double a.lrate)')
+    parser.add_argument(       '--multires', default=1, type=int, help='Coarse-to-fine resolution levels')
     # tweaks
     parser.add_argument('-a',  '--align',   default='uniform', choices=['central', 'uniform', 'overscan'], help='Sampling distribution')
     parser.add_argument('-tf', '--transform', action='store_true', help='use augmenting transforms?')
     parser.add_argument(       '--keep',    default=0, type=float, help='Accumulate imagery: 0 = random, 1 = prev ema')
+    parser.add_argument('-b',  '--batch',   default=1, type=int, help='Lines to process at once (only with --keep 0)')
+    parser.add_argument(       '--workers', default=1, type=int, help='Worker processes for lines (only with --keep 0)')
     parser.add_argument(       '--contrast', default=0.9, type=float)
     parser.add_argument(       '--colors',  default=1.5, type=float)
     parser.add_argument(       '--decay',   default=1.5, type=float)
@@ -58,11 +76,13 @@ def get_args():
     parser.add_argument('-e',  '--enhance', default=0, type=float, help='Enhance consistency, boosts training')
     parser.add_argument('-n',  '--noise',   default=0.2, type=float, help='Add noise to suppress accumulation')
     parser.add_argument('-nt', '--notext',  default=0, type=float, help='Subtract typed text as image (avoiding graffiti?), [0..1]') # 0.15
-    a = parser.parse_args()
+    a = parser.parse_args(argv)
 
     if a.size is not None: a.size = [int(s) for s in a.size.split('-')][::-1]
     if len(a.size)==1: a.size = a.size * 2
     if a.multilang is True: a.model = 'ViT-B/32' # sbert model is trained with ViT
+    if a.keep > 0: a.batch = 1 # every line starts from the previous ones
+    if a.resume is not None or a.keep > 0: a.multires = 1 # coarse start would drop the resumed details
     a.diverse = -a.enhance
     a.expand = abs(a.enhance)
     return a
@@ -74,36 +94,56 @@ def ema(base, next, step):
 def load_params(file):
     if not os.path.isfile(file):
         print(' Snapshot not found:', file); exit()
-    params = torch.load(file)
+    params = load_snap(file, dev.device)
     if isinstance(params, list): params = params[0]
     return params.detach().clone()
 
-def main():
-    a = get_args()
+def get_workdir(a):
+    workdir = os.path.join(a.out_dir, basename(a.in_txt))
+    workdir += '-%s' % a.model if 'RN' in a.model.upper() else ''
+    return workdir
 
+def setup(a, workdir, mtr=None, callback=None):
+    """ load models and encode texts, return line processing function """
+    if mtr is None: mtr = Metrics()
     # Load CLIP models
     use_jit = True if float(torch.__version__[:3]) < 1.8 else False
-    model_clip, _ = clip.load(a.model, jit=use_jit)
+    def load_clip():
+        model_clip, _ = clip.load(a.model, device=dev.device, jit=use_jit)
+        return dev.model(model_clip).requires_grad_(False) # grads are needed for the inputs only
+    model_clip = dev.load(('clip', a.model, use_jit), load_clip)
+    recompute(model_clip, a.recompute)
     try:
         a.modsize = model_clip.visual.input_resolution 
     except:
         a.modsize = 288 if a.model == 'RN50x4' else 384 if a.model == 'RN50x16' else 224
     if a.verbose is True: print(' using model', a.model)
+    samples = a.samples # as requested, for autotune
     xmem = {'ViT-B/16':0.25, 'RN50':0.5, 'RN50x4':0.16, 'RN50x16':0.06, 'RN101':0.33}
     if a.model in xmem.keys():
         a.samples = int(a.samples * xmem[a.model])
-    workdir = os.path.join(a.out_dir, basename(a.in_txt))
-    workdir += '-%s' % a.model if 'RN' in a.model.upper() else ''
-    os.makedirs(workdir, exist_ok=True)
+
+    embs = EmbCache(a.emb_cache)
+    model_lang = None
 
     def enc_text(txt):
-        if a.multilang is True:
-            model_lang = SentenceTransformer('clip-ViT-B-32-multilingual-v1').cuda()
-            emb = model_lang.encode([txt], convert_to_tensor=True, show_progress_bar=False)
-            del model_lang
-        else:
-            emb = model_clip.encode_text(clip.tokenize(txt).cuda())
-        return emb.detach().clone()
+        def calc():
+            nonlocal model_lang
+            if a.multilang is True:
+                if model_lang is None: # loaded once, only if not cached
+                    from sentence_transformers import SentenceTransformer
+                    model_lang = dev.load(('sbert',), lambda: SentenceTransformer('clip-ViT-B-32-multilingual-v1').to(dev.device))
+                emb = model_lang.encode([txt], convert_to_tensor=True, show_progress_bar=False, device=dev.device)
+            else:
+                emb = model_clip.encode_text(clip.tokenize(txt).to(dev.device))
+            return emb.detach().clone()
+        return embs.get(embs.key(a.model, txt, a.multilang), calc, dev.device)
+
+    def enc_plot(txt):
+        def calc():
+            txt_plot = torch.from_numpy(plot_text(txt, a.modsize)/255.).unsqueeze(0).permute(0,3,1,2).to(dev.device)
+            return dev.encode(model_clip, txt_plot).detach().clone()
+        return embs.get(embs.key(a.model, txt, False, 'plot', a.modsize), calc, dev.device)
     
     if a.diverse != 0:
         a.samples = int(a.samples * 0.5)
@@ -113,12 +153,13 @@ def main():
         trform_f = transforms.transforms_elastic
         a.samples = int(a.samples * 0.95)
     else:
-        trform_f = transforms.normalize()
+        trform_f = transforms.normalize(inplace=True)
 
     if a.in_txt2 is not None:
         if a.verbose is True: print(' style:', basename(a.in_txt2))
         # a.samples = int(a.samples * 0.75)
         if a.translate:
+            from googletrans import Translator
             translator = Translator()
             a.in_txt2 = translator.translate(a.in_txt2, dest='en').text
             if a.verbose is True: print(' translated to:', a.in_txt2)
@@ -127,34 +168,42 @@ def main():
     if a.in_txt0 is not None:
         if a.verbose is True: print(' subtract text:', basename(a.in_txt0))
         if a.translate:
+            from googletrans import Translator
             translator = Translator()
             a.in_txt0 = translator.translate(a.in_txt0, dest='en').text
             if a.verbose is True: print(' translated to:', a.in_txt0) 
         txt_enc0 = enc_text(a.in_txt0)
 
-    # make init
-    global params_start, params_ema
-    params_shape = [1, 3, a.size[0], a.size[1]//2+1, 2]
-    params_start = torch.randn(*params_shape).cuda() # random init
-    params_ema = 0.
-    if a.resume is not None and os.path.isfile(a.resume):
-        if a.verbose is True: print(' resuming from', a.resume)
-        params_start = load_params(a.resume).cuda()
-        if a.keep > 0:
-            params_ema = params_start[0].detach().clone()
-    else:
-        a.resume = 'init.pt'
+    if a.autotune is True: # instead of the guesses above, on a batch of random images
+        cuts = 2 if a.diverse != 0 else 1
+        params_tmp, image_tmp, _ = fft_image([a.batch, 3, *a.size], decay_power=a.decay)
+        image_tmp = to_valid_rgb(image_tmp, colors = a.colors)
+        def probe(n): # forward & backward on n samples per image, no update
+            img_sliced = slice_imgs([image_tmp()], n * cuts, a.modsize, trform_f, a.align, macro=a.macro)[0]
+            dev.encode(model_clip, img_sliced).mean().backward()
+            for p in params_tmp: p.grad = None
+        per_micro, a.micro = autotune(probe, samples, a.mem_budget, a.step_time, verbose=a.verbose)
+        a.samples = per_micro * a.micro
+        del params_tmp, image_tmp
+    if a.verbose is True: print(' samples:', a.samples if a.micro == 1 else '%d in %d micro-batches' % (a.samples, a.micro))
 
-    torch.save(params_start, 'init.pt') # final init
-    shutil.copy(a.resume, os.path.join(workdir, '000-%s.pt' % basename(a.resume)))
+    ckpt_file = os.path.join(workdir, '_resume.ckpt')
+
+    def chain_state(): # to resume the whole text
+        return {'params_start': params_start, 'params_ema': params_ema, 'init': load_params('init.pt')}
     
-    prev_enc = 0
-    def process(txt, num):
+    def process(txts, num, ckpt=None):
+        global params_ema
+        count = len(txts) # lines, optimized together as a batch
 
         sd = 0.01
         if a.keep > 0: sd = a.keep + (1-a.keep) * sd
-        params, image_f, _ = fft_image([1, 3, *a.size], resume='init.pt', sd=sd, decay_power=a.decay)
+        params_init = (load_params('init.pt') * sd).repeat(count, 1, 1, 1, 1)
+        params, image_f, _ = fft_image([count, 3, *a.size], resume=params_init, decay_power=a.decay)
         image_f = to_valid_rgb(image_f, colors = a.colors)
+        levels, lvl = res_levels(a.size, a.multires, a.modsize), 0 # not smaller than the cutouts
+        if a.multires > 1: # start from the coarsest level
+            params, image_f = fft_level(params, None, levels[lvl], a.decay, a.colors)
 
         if a.prog is True:
             lr1 = a.lrate * 2
@@ -163,116 +212,223 @@ def main():
             lr0 = a.lrate
         optimizer = torch.optim.AdamW(params, lr0, weight_decay=0.01, amsgrad=True)
     
-        if a.verbose is True: print(' topic: ', txt)
-        if a.translate:
-            translator = Translator()
-            txt = translator.translate(txt, dest='en').text
-            if a.verbose is True: print(' translated to:', txt)
-        txt_enc = enc_text(txt)
-        if a.notext > 0:
-            txt_plot = torch.from_numpy(plot_text(txt, a.modsize)/255.).unsqueeze(0).permute(0,3,1,2).cuda()
-            txt_plot_enc = model_clip.encode_image(txt_plot).detach().clone()
-        else: txt_plot_enc = None
-
-        out_name = '%03d-%s' % (num+1, txt_clean(txt))
-        out_name += '-%s' % a.model if 'RN' in a.model.upper() else ''
-        tempdir = os.path.join(workdir, out_name)
-        os.makedirs(tempdir, exist_ok=True)
-        
-        pbar = ProgressBar(a.steps // a.fstep)
-        for i in range(a.steps):
-            loss = 0
-            noise = a.noise * torch.randn(1, 1, *params[0].shape[2:4], 1).cuda() if a.noise > 0 else None
-            img_out = image_f(noise)
-            img_sliced = slice_imgs([img_out], a.samples, a.modsize, trform_f, a.align, macro=a.macro)[0]
-            out_enc = model_clip.encode_image(img_sliced)
-
-            loss -= torch.cosine_similarity(txt_enc, out_enc, dim=-1).mean()
-            if a.in_txt2 is not None: # input text - style
-                loss -= 0.5 * torch.cosine_similarity(txt_enc2, out_enc, dim=-1).mean()
-            if a.in_txt0 is not None: # subtract text
-                loss += 0.5 * torch.cosine_similarity(txt_enc0, out_enc, dim=-1).mean()
+        txt_enc, txt_plot_enc, out_names, tempdirs = [], [], [], []
+        for k, txt in enumerate(txts):
+            if a.verbose is True: print(' topic: ', txt)
+            if a.translate:
+                from googletrans import Translator
+                translator = Translator()
+                txt = translator.translate(txt, dest='en').text
+                if a.verbose is True: print(' translated to:', txt)
+            txt_enc.append(enc_text(txt))
             if a.notext > 0:
-                loss += a.notext * torch.cosine_similarity(txt_plot_enc, out_enc, dim=-1).mean()
-            if a.sharp != 0: # mode = scharr|sobel|default
-                loss -= a.sharp * derivat(img_out, mode='sobel')
-                # loss -= a.sharp * derivat(img_sliced, mode='scharr')
-            if a.diverse != 0:
-                img_sliced = slice_imgs([image_f(noise)], a.samples, a.modsize, trform_f, a.align, macro=a.macro)[0]
-                out_enc2 = model_clip.encode_image(img_sliced)
-                loss += a.diverse * torch.cosine_similarity(out_enc, out_enc2, dim=-1).mean()
-                del out_enc2; torch.cuda.empty_cache()
-            if a.expand > 0:
-                global prev_enc
-                if i > 0:
-                    loss += a.expand * torch.cosine_similarity(out_enc, prev_enc, dim=-1).mean()
-                prev_enc = out_enc.detach().clone()
-            del img_out, img_sliced, out_enc; torch.cuda.empty_cache()
-
-            if a.prog is True:
-                lr_cur = lr0 + (i / a.steps) * (lr1 - lr0)
-                for g in optimizer.param_groups: 
-                    g['lr'] = lr_cur
-        
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            if i % a.fstep == 0:
-                with torch.no_grad():
-                    img = image_f(contrast=a.contrast).cpu().numpy()[0]
-                if a.sharp != 0:
-                    img = img ** (1 + a.sharp/2.) # empirical tone mapping
-                checkout(img, os.path.join(tempdir, '%04d.jpg' % (i // a.fstep)), verbose=a.verbose)
-                pbar.upd()
-                del img
+                txt_plot_enc.append(enc_plot(txt))
+
+            out_name = '%03d-%s' % (num+k+1, txt_clean(txt))
+            out_name += '-%s' % a.model if 'RN' in a.model.upper() else ''
+            out_names.append(out_name)
+            tempdirs.append(os.path.join(workdir, out_name))
+            if a.frames: os.makedirs(tempdirs[-1], exist_ok=True)
+        if a.workers > 1 and all([os.path.isfile('%s.pt' % os.path.join(workdir, n)) for n in out_names]):
+            return # done in previous run
+        videos = [VideoWriter('%s.mp4' % os.path.join(workdir, out_name)) for out_name in out_names]
+        targets = Targets(count) # fixed targets, in one matmul
+        targets.add('txt', torch.cat(txt_enc), -1.) # per line
+        if a.in_txt2 is not None: # input text - style
+            targets.add('txt2', txt_enc2, -0.5)
+        if a.in_txt0 is not None: # subtract text
+            targets.add('txt0', txt_enc0, 0.5)
+        if a.notext > 0:
+            targets.add('notext', torch.cat(txt_plot_enc), a.notext)
+
+        step0 = 0
+        if ckpt is not None and ckpt['step'] is not None: # unfinished line
+            if res_level(ckpt['step'], a.steps, a.multires) > lvl:
+                lvl = res_level(ckpt['step'], a.steps, a.multires)
+                params, image_f = fft_level(params, optimizer, levels[lvl], a.decay, a.colors)
+            params[0].data.copy_(ckpt['params'][0])
+            optimizer.load_state_dict(ckpt['optim'])
+            step0 = ckpt['step'] + 1
+
+        with contextlib.ExitStack() as stack: # closed in reverse order, also on errors (server jobs)
+            for video in videos: stack.callback(video.close)
+            saver = FrameWriter(verbose=a.verbose)
+            stack.callback(saver.close)
+            pbar = ProgressBar(a.steps // a.fstep - step0 // a.fstep)
+            for i in range(step0, a.steps):
+                if res_level(i, a.steps, a.multires) > lvl: # coarse-to-fine
+                    lvl = res_level(i, a.steps, a.multires)
+                    params, image_f = fft_level(params, optimizer, levels[lvl], a.decay, a.colors)
+                if a.prog is True:
+                    lr_cur = lr0 + (i / a.steps) * (lr1 - lr0)
+                    for g in optimizer.param_groups: 
+                        g['lr'] = lr_cur
+
+                encs = []
+                targets.reset()
+                def enc_loss(out_enc, idx): # terms on encodings [count,n,dim], averaged over samples, summed over batch members
+                    pairs = [] # per-sample terms, besides the fixed targets
+                    if a.diverse != 0:
+                        out_enc, out_enc2 = out_enc.chunk(2, dim=1)
+                        pairs.append(('diverse', a.diverse, out_enc2))
+                    if a.expand > 0:
+                        if i > step0:
+                            pairs.append(('expand', a.expand, prev_enc[:, idx]))
+                        encs.append(out_enc.detach())
+                    return targets(out_enc, pairs)
+
+                with mtr.stage('param'):
+                    noise = dev.buffer('noise', [count, 1, *params[0].shape[2:4], 1]).normal_(0, a.noise) if a.noise > 0 else None # per batch member
+                    img_out = image_f(noise)
+                cuts = 2 if a.diverse != 0 else 1 # second set of samples for diversity, from the same render
+                with mtr.stage('slice'): # with augmentation
+                    img_sliced = slice_imgs([img_out], a.samples * cuts, a.modsize, trform_f, a.align, macro=a.macro)[0]
+                # encoder passes in micro-batches, down to the cutouts
+                loss, grad = micro_encode(model_clip, img_sliced, enc_loss, a.micro, count, cuts, mtr.stage)
+                if a.expand > 0:
+                    prev_enc = torch.cat(encs, 1)
+
+                with mtr.stage('backward'):
+                    optimizer.zero_grad(set_to_none=True)
+                    if a.sharp != 0: # mode = scharr|sobel|default
+                        img_loss = - a.sharp * count * derivat(img_out, mode='sobel')
+                        # img_loss = - a.sharp * derivat(img_sliced, mode='scharr')
+                        torch.autograd.backward([img_sliced, img_loss], [grad, None])
+                    else:
+                        img_sliced.backward(grad)
+                del img_out, img_sliced, grad
+                with mtr.stage('optim'):
+                    optimizer.step()
+
+                if i % a.fstep == 0:
+                    with mtr.stage('output'):
+                        with torch.no_grad():
+                            imgs = image_f(contrast=a.contrast)
+                            if list(imgs.shape[2:]) != a.size: # coarse level
+                                imgs = F.interpolate(imgs, a.size, mode='bilinear', align_corners=False)
+                            if a.sharp != 0:
+                                imgs = imgs ** (1 + a.sharp/2.) # empirical tone mapping
+                        for k in range(count):
+                            saver.put(imgs[k], os.path.join(tempdirs[k], '%04d.jpg' % (i // a.fstep)) if a.frames else None, videos[k], show = k==0)
+                            if i + a.fstep >= a.steps: # last frame
+                                saver.put(imgs[k], os.path.join(workdir, '%s-%d.jpg' % (out_names[k], a.steps)), show=False)
+                    pbar.upd()
+                    del imgs
+                    if callback is not None:
+                        callback(stage='lines', line=num, step=i, steps=a.steps, terms=targets.values(), frames=[os.path.join(tempdirs[k], '%04d.jpg' % (i // a.fstep)) for k in range(count)] if a.frames else None)
+
+                if a.ckpt > 0 and (i+1) % a.ckpt == 0:
+                    save_ckpt(ckpt_file, {'line': num, 'step': i, 'params': [params[0].detach()], 'optim': optimizer.state_dict(), **chain_state()})
+                dev.trim(a.mem_budget)
+                mtr.step(i, line=num, **(targets.values() if mtr.enabled else {}))
 
         if a.keep > 0:
-            global params_start, params_ema
             params_ema = ema(params_ema, params[0].detach().clone(), num+1)
-            torch.save((1-a.keep) * params_start + a.keep * params_ema, 'init.pt')
+            save_snap('init.pt', (1-a.keep) * params_start + a.keep * params_ema)
         
-        torch.save(params[0], '%s.pt' % os.path.join(workdir, out_name))
-        shutil.copy(img_list(tempdir)[-1], os.path.join(workdir, '%s-%d.jpg' % (out_name, a.steps)))
-        os.system('ffmpeg -v warning -y -i %s\%%04d.jpg "%s.mp4"' % (tempdir, os.path.join(workdir, out_name)))
+        for k in range(count):
+            save_snap('%s.pt' % os.path.join(workdir, out_names[k]), params[0][k:k+1], a.snap_fmt, a.snap_codec, a.decay)
+        if a.ckpt > 0:
+            save_ckpt(ckpt_file, {'line': num + count, 'step': None, **chain_state()})
+
+    return process
+
+_process = None
+def _init_worker(a, workdir):
+    global _process
+    dev.set(a.device, a.threads, a.bf16)
+    if a.metrics is not None: # one file per worker
+        a.metrics = '%s-%d%s' % (os.path.splitext(a.metrics)[0], os.getpid(), os.path.splitext(a.metrics)[1])
+    _process = setup(a, workdir, Metrics(a.metrics, None, name=basename(a.in_txt)))
+
+def _work(batch):
+    txts, num = batch
+    _process(txts, num)
+    return len(txts)
+
+def main(a=None, callback=None):
+    """ callback(**event) gets the progress per saved frame or line, e.g. from server.py """
+    if a is None: a = get_args()
+    dev.set(a.device, a.threads, a.bf16)
+    workdir = get_workdir(a)
+    os.makedirs(workdir, exist_ok=True)
+
+    # make init
+    global params_start, params_ema
+    ckpt_file = os.path.join(workdir, '_resume.ckpt') # not *.pt, to keep it off the keyframes
+    ckpt = load_ckpt(ckpt_file)
+    if ckpt is not None: # unfinished run
+        if a.verbose is True: print(' resuming from checkpoint, line', ckpt['line']+1)
+        params_start = ckpt['params_start'].to(dev.device)
+        params_ema = ckpt['params_ema']
+        if isinstance(params_ema, torch.Tensor): params_ema = params_ema.to(dev.device)
+        save_snap('init.pt', ckpt['init'])
+    else:
+        params_shape = [1, 3, a.size[0], a.size[1]//2+1, 2]
+        params_start = torch.randn(*params_shape, device=dev.device) # random init
+        params_ema = 0.
+        if a.resume is not None and os.path.isfile(a.resume):
+            if a.verbose is True: print(' resuming from', a.resume)
+            params_start = load_params(a.resume).to(dev.device)
+            if a.keep > 0:
+                params_ema = params_start[0].detach().clone()
+        else:
+            a.resume = 'init.pt'
+
+        save_snap('init.pt', params_start) # final init
+        shutil.copy(a.resume, os.path.join(workdir, '000-%s.pt' % basename(a.resume)))
 
     with open(a.in_txt, 'r', encoding="utf-8") as f:
         texts = f.readlines()
         texts = [tt.strip() for tt in texts if len(tt.strip()) > 0 and tt[0] != '#']
-    if a.verbose is True: 
-        print(' total lines:', len(texts))
-        print(' samples:', a.samples)
+    if a.verbose is True: print(' total lines:', len(texts))
 
-    for i, txt in enumerate(texts):
-        process(txt, i)
+    batches = [(texts[i : i + a.batch], i) for i in range(0, len(texts), a.batch)]
+    if a.workers > 1 and a.keep == 0: # independent lines
+        wa = argparse.Namespace(**vars(a))
+        wa.threads = max(1, (a.threads if a.threads > 0 else os.cpu_count()) // a.workers) # split cpu budget
+        wa.mem_budget = (a.mem_budget if a.mem_budget > 0 else dev.limit() / 2**30) / a.workers # and memory, for autotune
+        wa.verbose = False
+        wa.ckpt = 0 # finished lines are detected by their snapshots
+        wa.trace = None
+        ctx = torch.multiprocessing.get_context('spawn')
+        with ctx.Pool(a.workers, initializer=_init_worker, initargs=(wa, workdir)) as pool:
+            pbar = ProgressBar(len(texts))
+            for count in pool.imap_unordered(_work, batches):
+                for _ in range(count): pbar.upd()
+                if callback is not None:
+                    callback(stage='lines', lines=pbar.completed, total=len(texts))
+    else:
+        with contextlib.closing(Metrics(a.metrics, a.trace, name=basename(a.in_txt))) as mtr:
+            process = setup(a, workdir, mtr, callback)
+            line0 = 0 if ckpt is None else ckpt['line']
+            for txts, i in batches:
+                if i < line0: continue
+                process(txts, i, ckpt if i == line0 else None)
+            mtr.summary()
 
     vsteps = int(a.length * 25 / len(texts)) # 25 fps
     tempdir = os.path.join(workdir, '_final')
-    os.makedirs(tempdir, exist_ok=True)
-    
-    def read_pt(file):
-        return torch.load(file).cuda()
+    if a.frames: os.makedirs(tempdir, exist_ok=True)
 
     if a.verbose is True: print(' rendering complete piece')
     ptfiles = file_list(workdir, 'pt')
-    pbar = ProgressBar(vsteps * len(ptfiles))
-    for px in range(len(ptfiles)):
-        params1 = read_pt(ptfiles[px])
-        params2 = read_pt(ptfiles[(px+1) % len(ptfiles)])
-
-        params, image_f, _ = fft_image([1, 3, *a.size], resume=params1, sd=1., decay_power=a.decay)
-        image_f = to_valid_rgb(image_f, colors = a.colors)
-
-        for i in range(vsteps):
-            with torch.no_grad():
-                img = image_f((params2 - params1) * math.sin(1.5708 * i/vsteps)**2)[0].permute(1,2,0)
-                img = torch.clip(img*255, 0, 255).cpu().numpy().astype(np.uint8)
-            imsave(os.path.join(tempdir, '%05d.jpg' % (px * vsteps + i)), img)
-            if a.verbose is True: cvshow(img)
-            pbar.upd()
+    with contextlib.ExitStack() as stack:
+        video = VideoWriter('%s.mp4' % os.path.join(a.out_dir, basename(a.in_txt)))
+        stack.callback(video.close)
+        saver = FrameWriter(verbose=a.verbose)
+        stack.callback(saver.close)
+        pbar = ProgressBar(vsteps * len(ptfiles))
+        for px, (params1, params2) in enumerate(keyframes(ptfiles, dev.device)):
+            for i, img in enumerate(interpolate(params1, params2, vsteps, a.decay, a.colors)):
+                saver.put(img, os.path.join(tempdir, '%05d.jpg' % (px * vsteps + i)) if a.frames else None, video)
+                pbar.upd()
+                if callback is not None:
+                    callback(stage='render', step=px * vsteps + i, steps=vsteps * len(ptfiles), frames=[os.path.join(tempdir, '%05d.jpg' % (px * vsteps + i))] if a.frames else None)
 
-    os.system('ffmpeg -v warning -y -i %s\%%05d.jpg "%s.mp4"' % (tempdir, os.path.join(a.out_dir, basename(a.in_txt))))
     if a.keep > 0: os.remove('init.pt')
+    if os.path.isfile(ckpt_file): os.remove(ckpt_file)
+    return '%s.mp4' % os.path.join(a.out_dir, basename(a.in_txt))
 
 
 if __name__ == '__main__':
@@ -2,14 +2,13 @@ import os
 import warnings
 warnings.filterwarnings("ignore")
 import argparse
-import math
 import numpy as np
-from imageio import imsave
 
 import torch
 
-from clip_fft import to_valid_rgb, fft_image
-from utils import basename, file_list, cvshow
+from param import to_valid_rgb, fft_image
+from snapshot import load_snap, keyframes
+from utils import dev, basename, file_list, slerp, smoothstep, FrameWriter, VideoWriter
 try: # progress bar for notebooks 
     get_ipython().__class__.__name__
     from progress_bar import ProgressIPy as ProgressBar
@@ -23,41 +22,60 @@ def get_args():
     parser.add_argument('-l', '--length',  default=60, type=int, help='Total length in sec')
     parser.add_argument('-s', '--steps',   default=None, type=int, help='Override length')
     parser.add_argument('-v', '--verbose', default=True, type=bool)
+    parser.add_argument(      '--frames',  action='store_true', help='Keep jpg frames (besides the video)')
+    parser.add_argument('-b', '--batch',   default=8, type=int, help='Frames to render at once')
+    parser.add_argument(      '--curve',   default='sin', choices=['sin', 'smooth', 'linear'], help='Easing curve between keyframes')
+    parser.add_argument(      '--slerp',   action='store_true', help='Norm-preserving (spherical) interpolation')
+    parser.add_argument(      '--device',  default=None, help='cuda, cpu, etc. (autodetect by default)')
+    parser.add_argument(      '--threads', default=0, type=int, help='CPU threads to use (0 = torch default)')
     a = parser.parse_args()
     return a
 
 def read_pt(file):
-    return torch.load(file)[0].cuda()
+    params = load_snap(file, dev.device)
+    return params[0] if isinstance(params, list) else params
+
+def ease(x, curve='sin'):
+    if curve == 'linear':
+        return x
+    elif curve == 'smooth':
+        return smoothstep(x, 1)
+    return np.sin(0.5 * np.pi * x) ** 2
+
+def interpolate(params1, params2, steps, decay=1., colors=1., batch=8, curve='sin', spherical=False):
+    """ yields frames [3,h,w] from params1 towards params2 (excluding it), rendering a batch of them per inverse FFT """
+    shape = [1, 3, params1.shape[2], (params1.shape[3]-1)*2]
+    _, image_f, _ = fft_image(shape, decay_power=decay, resume=params1)
+    image_f = to_valid_rgb(image_f, colors=colors)
+    xs = ease(np.arange(steps) / steps, curve)
+    with torch.no_grad():
+        for i in range(0, steps, batch):
+            x = xs[i : i+batch]
+            if spherical is True:
+                shift = slerp(params1, params2, x=x, smooth=0) - params1
+            else:
+                shift = (params2 - params1) * torch.tensor(x, dtype=params1.dtype, device=params1.device).reshape(-1,1,1,1,1)
+            for img in image_f(shift):
+                yield img
 
 def main():
     a = get_args()
+    dev.set(a.device, a.threads)
     tempdir = os.path.join(a.out_dir, 'a')
-    os.makedirs(tempdir, exist_ok=True)
+    os.makedirs(tempdir if a.frames else a.out_dir, exist_ok=True)
+    video = VideoWriter('%s-pts.mp4' % a.in_dir.rstrip('/\\'))
     
     ptfiles = file_list(a.in_dir, 'pt')
 
-    ptest = torch.load(ptfiles[0])
-    if isinstance(ptest, list): ptest = ptest[0]
-    shape = [*ptest.shape[:3], (ptest.shape[3]-1)*2]
-
     vsteps = int(a.length * 25 / len(ptfiles)) if a.steps is None else a.steps # 25 fps
+    saver = FrameWriter(verbose=a.verbose)
     pbar = ProgressBar(vsteps * len(ptfiles))
-    for px in range(len(ptfiles)):
-        params1 = read_pt(ptfiles[px])
-        params2 = read_pt(ptfiles[(px+1) % len(ptfiles)])
-
-        params, image_f, _ = fft_image(shape, resume=params1)
-        image_f = to_valid_rgb(image_f)
-
-        for i in range(vsteps):
-            with torch.no_grad():
-                img = image_f((params2 - params1) * math.sin(1.5708 * i/vsteps)**2)[0].permute(1,2,0)
-                img = torch.clip(img*255, 0, 255).cpu().numpy().astype(np.uint8)
-            imsave(os.path.join(tempdir, '%05d.jpg' % (px * vsteps + i)), img)
-            if a.verbose is True: cvshow(img)
+    for px, (params1, params2) in enumerate(keyframes(ptfiles, dev.device)):
+        for i, img in enumerate(interpolate(params1, params2, vsteps, batch=a.batch, curve=a.curve, spherical=a.slerp)):
+            saver.put(img, os.path.join(tempdir, '%05d.jpg' % (px * vsteps + i)) if a.frames else None, video)
             pbar.upd()
-
-    os.system('ffmpeg -v warning -y -i %s\%%05d.jpg "%s-pts.mp4"' % (tempdir, a.in_dir))
+    saver.close()
+    video.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+"""
+from metrics import Metrics
+
+mtr = Metrics('metrics.jsonl') # or .csv; Metrics(None) does nothing
+with mtr.stage('encode'):
+    ...
+mtr.step(i)
+mtr.summary()
+"""
+
+import os
+import csv
+import json
+import time
+import contextlib
+
+import torch
+
+from utils import dev
+
+class Metrics(object):
+    '''Wall time and peak memory of training stages per step,
+    streamed as jsonl/csv rows, with optional torch.profiler traces
+    '''
+    def __init__(self, path=None, trace=None, **tags):
+        self.enabled = path is not None or trace is not None
+        self.tags = tags
+        self.row = {}
+        self.total = {}
+        self.steps = 0
+        self.file = None
+        self.fields, self.rows = [], [] # csv columns may appear later (e.g. loss terms), then the file is rewritten
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, 'a', newline='')
+            self.start = self.file.tell()
+            self.csv = os.path.splitext(path)[1].lower() == '.csv'
+        self.prof = None
+        if trace is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if dev.cuda: activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities, schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
+                                               on_trace_ready=torch.profiler.tensorboard_trace_handler(trace), profile_memory=True)
+            self.prof.start()
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        dev.sync()
+        dev.peak(reset=True)
+        t0 = time.perf_counter()
+        with torch.autograd.profiler.record_function(name):
+            yield
+        dev.sync()
+        self.row[name + '_ms'] = self.row.get(name + '_ms', 0.) + (time.perf_counter() - t0) * 1000.
+        self.row[name + '_mb'] = max(self.row.get(name + '_mb', 0.), dev.peak() / 2**20)
+
+    def stage(self, name):
+        return self._stage(name) if self.enabled else contextlib.nullcontext()
+
+    def step(self, i, **tags):
+        if not self.enabled: return
+        if self.prof is not None: self.prof.step()
+        row = {**self.tags, **tags, 'step': i, **self.row}
+        for k, v in self.row.items():
+            if k.endswith('_ms'): self.total[k] = self.total.get(k, 0.) + v
+            else: self.total[k] = max(self.total.get(k, 0.), v)
+        self.steps += 1
+        self.row = {}
+        if self.file is not None:
+            if self.csv is True:
+                self.rows.append(row)
+                new = [k for k in row if k not in self.fields]
+                self.fields += new
+                writer = csv.DictWriter(self.file, fieldnames=self.fields)
+                if len(new) > 0: # (re)write with all columns
+                    self.file.seek(self.start)
+                    self.file.truncate()
+                    if self.start == 0: writer.writeheader()
+                    writer.writerows(self.rows)
+                else:
+                    writer.writerow(row)
+            else:
+                self.file.write(json.dumps(row) + '\n')
+            self.file.flush()
+
+    def summary(self):
+        if not self.enabled or self.steps == 0: return
+        stages = [k[:-3] for k in self.total if k.endswith('_ms')]
+        total = sum([self.total[s + '_ms'] for s in stages])
+        print(' %-12s %10s %8s %10s' % ('stage', 'ms/step', '%', 'peak MB'))
+        for s in stages:
+            ms = self.total[s + '_ms']
+            print(' %-12s %10.2f %8.1f %10.1f' % (s, ms / self.steps, 100. * ms / max(total, 1e-9), self.total.get(s + '_mb', 0.)))
+        print(' %-12s %10.2f' % ('total', total / self.steps))
+
+    def close(self):
+        if self.prof is not None:
+            self.prof.stop()
+            self.prof = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
@@ -0,0 +1,291 @@
+"""
+Image parametrizations (FFT, DWT, pixels), no model dependencies
+
+from param import fft_image, to_valid_rgb
+
+params, image_f, size = fft_image([1, 3, h, w], decay_power=1.5)
+image_f = to_valid_rgb(image_f, colors=1.5)
+img = image_f() # [1,3,h,w] in 0..1
+"""
+
+import os
+import math
+import numpy as np
+from imageio import imread
+
+import torch
+
+from utils import dev, tiled
+from snapshot import load_snap
+
+### FFT from Lucent library ###  https://github.com/greentfrapp/lucent
+
+# parametrization constants, kept on device and shared between images
+_consts = {}
+
+def _cached(key, calc):
+    if key not in _consts:
+        _consts[key] = calc()
+    return _consts[key]
+
+def color_matrix(colors=1., inverse=False, device=None, dtype=torch.float32):
+    def calc():
+        color_correlation_svd_sqrt = np.asarray([[0.26, 0.09, 0.02],
+                                                 [0.27, 0.00, -0.05],
+                                                 [0.27, -0.09, 0.03]]).astype("float32")
+        color_correlation_svd_sqrt /= np.asarray([colors, 1., 1.]) # saturate, empirical
+        max_norm_svd_sqrt = np.max(np.linalg.norm(color_correlation_svd_sqrt, axis=0))
+        color_correlation_normalized = color_correlation_svd_sqrt / max_norm_svd_sqrt
+        if inverse is True:
+            color_correlation_normalized = np.linalg.inv(color_correlation_normalized)
+        return torch.tensor(color_correlation_normalized.T, dtype=dtype, device=device)
+    return _cached(('color', colors, inverse, str(device), dtype), calc)
+
+def spectrum_scale(h, w, decay_power, floor=4., device=None, dtype=torch.float32):
+    def calc():
+        freqs = rfft2d_freqs(h, w)
+        scale = 1. / np.maximum(freqs, floor / max(h,w)) ** decay_power
+        scale *= np.sqrt(h*w)
+        return torch.tensor(scale, dtype=dtype, device=device)[None, None, ..., None]
+    return _cached(('scale', h, w, decay_power, floor, str(device), dtype), calc)
+
+def to_valid_rgb(image_f, colors=1., decorrelate=True, tile=0, sparse=True):
+    def _linear_decorrelate_color(tensor):
+        t_permute = tensor.permute(0,2,3,1)
+        t_permute = torch.matmul(t_permute, color_matrix(colors, device=tensor.device, dtype=tensor.dtype))
+        tensor = t_permute.permute(0,3,1,2)
+        return tensor
+
+    def post(image):
+        if decorrelate:
+            image = _linear_decorrelate_color(image)
+        return torch.sigmoid(image)
+
+    def inner(*args, **kwargs):
+        return tiled(post, image_f(*args, **kwargs), tile, sparse=sparse)
+    return inner
+    
+def init_dwt(resume=None, shape=None, wave=None, colors=None):
+    import pywt
+    from pytorch_wavelets import DWTForward, DWTInverse # DTCWTForward, DTCWTInverse
+    size = None
+    wp_fake = pywt.WaveletPacket2D(data=np.zeros(shape[2:]), wavelet='db1', mode='symmetric')
+    xfm = DWTForward(J=wp_fake.maxlevel, wave=wave, mode='symmetric').to(dev.device)
+    # xfm = DTCWTForward(J=lvl, biort='near_sym_b', qshift='qshift_b').cuda() # 4x more params, biort ['antonini','legall','near_sym_a','near_sym_b']
+    ifm = DWTInverse(wave=wave, mode='symmetric').to(dev.device) # symmetric zero periodization
+    # ifm = DTCWTInverse(biort='near_sym_b', qshift='qshift_b').cuda() # 4x more params, biort ['antonini','legall','near_sym_a','near_sym_b']
+    if resume is None: # random init
+        Yl_in, Yh_in = xfm(torch.zeros(shape, device=dev.device))
+        Ys = [torch.randn(*Y.shape, device=dev.device, dtype=dev.dtype) for Y in [Yl_in, *Yh_in]]
+    elif isinstance(resume, str):
+        if os.path.isfile(resume):
+            if os.path.splitext(resume)[1].lower()[1:] in ['jpg','png','tif','bmp']:
+                img_in = imread(resume)
+                Ys = img2dwt(img_in, wave=wave, colors=colors)
+                print(' loaded image', resume, img_in.shape, 'level', len(Ys)-1)
+                size = img_in.shape[:2]
+                wp_fake = pywt.WaveletPacket2D(data=np.zeros(size), wavelet='db1', mode='symmetric')
+                xfm = DWTForward(J=wp_fake.maxlevel, wave=wave, mode='symmetric').to(dev.device)
+            else:
+                Ys = load_snap(resume, dev.device)
+                Ys = [y.detach().to(dev.device) for y in Ys]
+        else: print(' Snapshot not found:', resume); exit()
+    else:
+        Ys = [y.to(dev.device) for y in resume]
+    # print('level', len(Ys)-1, 'low freq', Ys[0].cpu().numpy().shape)
+    return Ys, xfm, ifm, size
+
+def dwt_image(shape, wave='coif2', sharp=0.3, colors=1., resume=None):
+    Ys, _, ifm, size = init_dwt(resume, shape, wave, colors)
+    Ys = [y.requires_grad_(True) for y in Ys]
+    scale = dwt_scale(Ys, sharp)
+
+    def inner(shift=None, contrast=1.):
+        image = ifm((Ys[0], [Ys[i+1] * float(scale[i]) for i in range(len(Ys)-1)]))
+        image = image * contrast / image.std() # keep contrast, empirical *1.33
+        return image
+
+    return Ys, inner, size
+
+def dwt_scale(Ys, sharp):
+    scale = []
+    [h0,w0] = Ys[1].shape[3:5]
+    for i in range(len(Ys)-1):
+        [h,w] = Ys[i+1].shape[3:5]
+        scale.append( ((h0*w0)/(h*w)) ** (1.-sharp) )
+        # print(i+1, Ys[i+1].shape)
+    return scale
+
+def img2dwt(img_in, wave='coif2', sharp=0.3, colors=1.):
+    if not isinstance(img_in, torch.Tensor):
+        img_in = torch.Tensor(img_in).to(dev.device).permute(2,0,1).unsqueeze(0).float() / 255.
+    img_in = un_rgb(img_in, colors=colors)
+    import pywt
+    from pytorch_wavelets import DWTForward
+    with torch.no_grad():
+        wp_fake = pywt.WaveletPacket2D(data=np.zeros(img_in.shape[2:]), wavelet='db1', mode='zero')
+        lvl = wp_fake.maxlevel
+        # print(img_in.shape, lvl)
+        xfm = DWTForward(J=lvl, wave=wave, mode='symmetric').to(dev.device)
+        Yl_in, Yh_in = xfm(img_in.to(dev.device))
+        Ys = [Yl_in, *Yh_in]
+    scale = dwt_scale(Ys, sharp)
+    for i in range(len(Ys)-1):
+        Ys[i+1] /= scale[i]
+    return Ys
+
+def pixel_image(shape, resume=None, sd=1., *noargs, **nokwargs):
+    size = None
+    if resume is None:
+        tensor = torch.randn(*shape, dtype=dev.dtype) * sd
+    elif isinstance(resume, str):
+        if os.path.isfile(resume):
+            img_in = imread(resume) / 255.
+            tensor = torch.Tensor(img_in).permute(2,0,1).unsqueeze(0).float()
+            tensor = un_rgb(tensor-0.5, colors=2.) # experimental
+            size = img_in.shape[:2]
+            print(resume, size)
+        else: print(' Image not found:', resume); exit()
+    else:
+        if isinstance(resume, list): resume = resume[0]
+        tensor = resume
+    tensor = tensor.to(dev.device).requires_grad_(True)
+
+    def inner(shift=None, contrast=1.): # *noargs, **nokwargs
+        image = tensor * contrast / tensor.std()
+        return image
+    return [tensor], inner, size # lambda: tensor
+
+# From https://github.com/tensorflow/lucid/blob/master/lucid/optvis/param/spatial.py
+def rfft2d_freqs(h, w):
+    """Computes 2D spectrum frequencies."""
+    fy = np.fft.fftfreq(h)[:, None]
+    # when we have an odd input dimension we need to keep one additional frequency and later cut off 1 pixel
+    w2 = (w+1)//2 if w%2 == 1 else w//2+1
+    fx = np.fft.fftfreq(w)[:w2]
+    return np.sqrt(fx * fx + fy * fy)
+
+def resume_fft(resume=None, shape=None, decay=None, colors=1.6, sd=0.01):
+    size = None
+    if resume is None: # random init
+        params_shape = [*shape[:3], shape[3]//2+1, 2] # [1,3,512,257,2] for 512x512 (2 for imaginary and real components)
+        params = 0.01 * torch.randn(*params_shape, device=dev.device, dtype=dev.dtype)
+    elif isinstance(resume, str):
+        if os.path.isfile(resume):
+            if os.path.splitext(resume)[1].lower()[1:] in ['jpg','png','tif','bmp']:
+                img_in = imread(resume)
+                params = img2fft(img_in, decay, colors)
+                size = img_in.shape[:2]
+            else:
+                params = load_snap(resume, dev.device)
+                if isinstance(params, list): params = params[0]
+                params = params.detach().to(dev.device, dev.dtype)
+            params *= sd
+        else: print(' Snapshot not found:', resume); exit()
+    else:
+        if isinstance(resume, list): resume = resume[0]
+        params = resume.to(dev.device, dev.dtype)
+    return params, size
+
+def fft_std(rows, w):
+    """ std of irfft(rows, n=w) over channels & pixels per batch member, from the spectrum (Parseval) """
+    def calc():
+        wts = torch.full([rows.shape[-1]], 2., device=rows.device)
+        wts[0] = 1. # DC & Nyquist columns are real
+        if w % 2 == 0: wts[-1] = 1.
+        return wts, wts * (wts > 1.) # imaginary parts of real columns are dropped by irfft
+    wts_re, wts_im = _cached(('fftstd', rows.shape[-1], w, str(rows.device)), calc)
+    n = rows.shape[1] * rows.shape[2] * w
+    sq = (rows.real**2 * wts_re + rows.imag**2 * wts_im).sum((1,2,3))
+    sm = rows.real[..., 0].sum((1,2)) * math.sqrt(w)
+    return ((sq - sm**2 / n) / (n-1)).sqrt()[:, None, None, None]
+
+def fft_image(shape, sd=0.01, decay_power=1.0, resume=None, tile=0, sparse=True): # decay ~ blur
+
+    params, size = resume_fft(resume, shape, decay_power, sd=sd)
+    spectrum_real_imag_t = params.requires_grad_(True)
+    if size is not None: shape[2:] = size
+    [h,w] = list(shape[2:])
+
+    scale = spectrum_scale(h, w, decay_power, device=dev.device, dtype=dev.dtype)
+
+    def inner(shift=None, contrast=1.):
+        scaled_spectrum_t = scale * spectrum_real_imag_t
+        if shift is not None:
+            scaled_spectrum_t = scaled_spectrum_t + scale * shift # may be batched
+        if float(torch.__version__[:3]) < 1.8:
+            image = torch.irfft(scaled_spectrum_t, 2, normalized=True, signal_sizes=(h, w))
+        else:
+            if type(scaled_spectrum_t) is not torch.complex64:
+                scaled_spectrum_t = torch.view_as_complex(scaled_spectrum_t)
+            if tile > 0: # render by row strips, global std from the spectrum
+                rows = torch.fft.ifft(scaled_spectrum_t, dim=2, norm='ortho')
+                return tiled(lambda x, std: torch.fft.irfft(x, n=w, dim=3, norm='ortho') * contrast / std, rows, tile, fft_std(rows, w), sparse=sparse)
+            image = torch.fft.irfftn(scaled_spectrum_t, s=(h, w), norm='ortho')
+        image = image * contrast / image.std((1,2,3), keepdim=True) # keep contrast, empirical; per batch member
+        return image
+
+    return [spectrum_real_imag_t], inner, size
+
+def fft_resize(spectrum, h, w):
+    """ zero-pad (or crop) rfft spectrum [..., h0, w0//2+1, 2] to image size h x w = upsample in frequency space """
+    h0, w0 = spectrum.shape[-3:-1]
+    out = torch.zeros(*spectrum.shape[:-3], h, w//2+1, 2, device=spectrum.device, dtype=spectrum.dtype)
+    hh, ww = min(h0, h), min(w0, w//2+1)
+    top = (hh+1) // 2 # positive frequencies, then negative ones
+    out[..., :top, :ww, :] = spectrum[..., :top, :ww, :]
+    if hh - top > 0:
+        out[..., h-(hh-top):, :ww, :] = spectrum[..., h0-(hh-top):, :ww, :]
+    return out
+
+def fft_level(params, optimizer, size, decay_power=1.0, colors=1., tile=0, sparse=True):
+    """ move FFT params to another resolution, with optimizer moments; spectrum scale is relative, so decay is kept """
+    old = params[0]
+    params, image_f, _ = fft_image([old.shape[0], 3, *size], decay_power=decay_power, resume=fft_resize(old.detach(), *size), tile=tile, sparse=sparse)
+    if optimizer is not None:
+        for g in optimizer.param_groups:
+            g['params'] = [params[0] if p is old else p for p in g['params']]
+        state = optimizer.state.pop(old, {})
+        optimizer.state[params[0]] = {k: fft_resize(v, *size) if torch.is_tensor(v) and v.shape == old.shape else v for k, v in state.items()}
+    return params, to_valid_rgb(image_f, colors=colors, tile=tile, sparse=sparse)
+
+def res_levels(size, count, min_size=0): # coarse-to-fine sizes, halved per level, short side not below min_size
+    scales = [min(2**(count-1-l), max(1., min(size) / max(min_size, 1))) for l in range(count)]
+    return [[int(s / k) for s in size] for k in scales]
+
+def res_level(i, steps, count): # coarse levels share the first half of steps
+    return min(count-1, i * 2 * (count-1) // steps)
+
+def inv_sigmoid(x):
+    eps = 1.e-12
+    x = torch.clamp(x.double(), eps, 1-eps)
+    y = torch.log(x/(1-x))
+    return y.float()
+
+def un_rgb(image, colors=1.):
+    image = inv_sigmoid(image)
+    t_permute = image.permute(0,2,3,1)
+    t_permute = torch.matmul(t_permute, color_matrix(colors, inverse=True, device=image.device, dtype=image.dtype))
+    image = t_permute.permute(0,3,1,2)
+    return image
+
+def un_spectrum(spectrum, decay_power):
+    h = spectrum.shape[2]
+    w = (spectrum.shape[3]-1)*2
+    scale = spectrum_scale(h, w, decay_power, floor=1., device=spectrum.device)
+    return spectrum / scale
+
+def img2fft(img_in, decay=1., colors=1.):
+    h, w = img_in.shape[0], img_in.shape[1]
+    img_in = torch.Tensor(img_in).to(dev.device).permute(2,0,1).unsqueeze(0) / 255.
+    img_in = un_rgb(img_in, colors=colors)
+
+    with torch.no_grad():
+        if float(torch.__version__[:3]) < 1.8:
+            spectrum = torch.rfft(img_in, 2, normalized=True) # 1.7
+        else:
+            spectrum = torch.fft.rfftn(img_in, s=(h, w), dim=[2,3], norm='ortho') # 1.8
+            spectrum = torch.view_as_real(spectrum)
+        spectrum = un_spectrum(spectrum, decay_power=decay)
+        spectrum *= 500000. # [sic!!!]
+    return spectrum
@@ -13,10 +13,10 @@ os.system('') #enable VT100 Escape Sequence for WINDOWS 10 Ver. 1607
 from shutil import get_terminal_size
 import time
 
-import ipywidgets as ipy
-import IPython
 class ProgressIPy(object):
     def __init__(self, task_num=10):
+        import ipywidgets as ipy # notebooks only
+        import IPython
         self.pbar = ipy.IntProgress(min=0, max=task_num, bar_style='') # (value=0, min=0, max=max, step=1, description=description, bar_style='')
         self.labl = ipy.Label()
         IPython.display.display(ipy.HBox([self.pbar, self.labl]))
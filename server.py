@@ -0,0 +1,97 @@
+"""
+Persistent worker: keeps CLIP/LPIPS/SBERT models loaded between jobs, runs them one by one.
+Jobs are JSON lines, via stdin (default) or unix socket; replies are JSON lines too.
+
+python server.py [--socket /tmp/aphantasia.sock]
+{"id": 1, "script": "clip_fft", "args": {"in_txt": "the text", "size": "1280-720", "steps": 100, "frames": true}}
+{"id": 2, "script": "illustra", "args": ["-i", "mytext.txt", "--steps", "200"]}
+
+replies: {"id": 1, "event": "progress", "step": 0, "steps": 100, "frames": [..]}, then "done" (with "out") or "error"
+frames are written in background, they're complete at "done"
+"""
+
+import os
+import sys
+import json
+import argparse
+import contextlib
+import socketserver
+import traceback
+
+from utils import dev
+import clip_fft
+import illustra
+
+scripts = {'clip_fft': clip_fft, 'illustra': illustra}
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--socket', default=None, help='Unix socket path (stdin/stdout by default)')
+    return parser.parse_args()
+
+def to_argv(args):
+    """ job args as command line, or as dict of long option names: true = flag, false/null = omitted """
+    if isinstance(args, (list, tuple)):
+        return [str(x) for x in args]
+    argv = []
+    for k, v in args.items():
+        if v is None or v is False: continue
+        argv.append('--' + k)
+        if v is not True: argv.append(str(v))
+    return argv
+
+def run(job, reply):
+    jid = job.get('id')
+    try:
+        script = scripts[job.get('script', 'clip_fft')]
+        a = script.get_args(to_argv(job.get('args', [])))
+        a.verbose = False # no preview windows on headless workers; progress goes to the client
+        out = script.main(a, lambda **event: reply({'id': jid, 'event': 'progress', **event}))
+        reply({'id': jid, 'event': 'done', 'out': out})
+    except (Exception, SystemExit) as e: # argparse & missing files exit
+        traceback.print_exc(file=sys.stderr)
+        reply({'id': jid, 'event': 'error', 'error': '%s: %s' % (type(e).__name__, e)})
+
+def serve_stdio():
+    stdout = sys.stdout
+    def reply(msg):
+        stdout.write(json.dumps(msg) + '\n')
+        stdout.flush()
+    with contextlib.redirect_stdout(sys.stderr): # keep stdout for replies
+        for line in sys.stdin:
+            if len(line.strip()) == 0: continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                reply({'id': None, 'event': 'error', 'error': 'bad json: %s' % e}); continue
+            run(job, reply)
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        def reply(msg):
+            self.wfile.write((json.dumps(msg) + '\n').encode('utf-8'))
+            self.wfile.flush()
+        for line in self.rfile:
+            if len(line.strip()) == 0: continue
+            try:
+                job = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                reply({'id': None, 'event': 'error', 'error': 'bad json: %s' % e}); continue
+            run(job, reply)
+
+def main():
+    a = get_args()
+    dev.resident = True
+    if a.socket is None:
+        serve_stdio()
+    else:
+        if os.path.exists(a.socket): os.remove(a.socket)
+        with socketserver.UnixStreamServer(a.socket, Handler) as server: # one client & job at a time, for one gpu
+            print(' listening on', a.socket)
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(a.socket)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+from snapshot import save_snap, load_snap, keyframes
+
+save_snap('x.pt', params) # tensor or list of tensors
+save_snap('x.pt', params, 'q8', 'zstd', decay=1.5) # float16 or 8bit per frequency band, optionally compressed
+params = load_snap('x.pt', device) # reads torch.save files as well
+for params1, params2 in keyframes(files, device):
+    ...
+"""
+
+import os
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import torch
+try: # optional compression
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b'APHSNAP\0'
+ALIGN = 64
+formats = ['float32', 'float16', 'q8']
+codecs = ['zstd', 'lz4']
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def is_snap(file):
+    with open(file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def _bands(shape):
+    """ octave bands of rfft spectrum [..., h, w//2+1, 2] by radial frequency; one band for other tensors """
+    if len(shape) < 3 or shape[-1] != 2:
+        return np.zeros(shape, dtype=np.int64)
+    h, wr = shape[-3:-1]
+    w = (wr - 1) * 2
+    freqs = np.sqrt((np.fft.fftfreq(h)[:, None] * h)**2 + (np.arange(wr)[None, :] * h / w)**2) # cycles per image height
+    return np.clip(np.floor(np.log2(np.maximum(freqs, 0.5))) + 1, 0, None).astype(np.int64)[..., None]
+
+def _weights(shape, decay=None):
+    """ render scale of rfft spectrum params (as param.spectrum_scale, up to a constant); ones for other tensors """
+    if decay is None or len(shape) < 3 or shape[-1] != 2:
+        return np.ones([1], dtype=np.float32)
+    h, wr = shape[-3:-1]
+    w = max((wr - 1) * 2, 1)
+    freqs = np.sqrt(np.fft.fftfreq(h)[:, None]**2 + (np.arange(wr)[None, :] / w)**2)
+    return (1. / np.maximum(freqs, 4. / max(h, w)) ** decay).astype(np.float32)[..., None]
+
+def _encode(arr, fmt, codec, decay=None):
+    entry = {'shape': list(arr.shape), 'dtype': arr.dtype.name, 'format': fmt}
+    if fmt == 'float16':
+        arr = arr.astype(np.float16)
+    elif fmt == 'q8': # 8bit with absmax scale per band, on the rendered (decayed) spectrum, so the error follows the image
+        wts = _weights(arr.shape, decay)
+        arr = arr * wts
+        bands = np.broadcast_to(_bands(arr.shape), arr.shape)
+        scales = np.zeros(bands.max() + 1, dtype=np.float32)
+        np.maximum.at(scales, bands.ravel(), np.abs(arr).ravel())
+        scales = np.maximum(scales, 1e-12)
+        arr = np.round(arr / scales[bands] * 127).astype(np.int8)
+        entry.update({'scales': scales.tolist(), 'decay': decay})
+    data = arr.tobytes()
+    if codec == 'zstd':
+        data = zstandard.ZstdCompressor(level=9).compress(data)
+    elif codec == 'lz4':
+        data = lz4.frame.compress(data)
+    entry.update({'stored': arr.dtype.name, 'codec': codec, 'nbytes': len(data)})
+    return entry, data
+
+def _decode(data, entry):
+    if entry['codec'] == 'zstd':
+        if zstandard is None: raise ImportError(' zstandard is needed to read this snapshot')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif entry['codec'] == 'lz4':
+        if lz4 is None: raise ImportError(' lz4 is needed to read this snapshot')
+        data = lz4.frame.decompress(data)
+    arr = np.frombuffer(data, dtype=np.dtype(entry['stored'])).reshape(entry['shape'])
+    if entry['format'] == 'q8':
+        arr = arr.astype(np.float32) * (np.array(entry['scales'], dtype=np.float32) / 127)[_bands(arr.shape)]
+        arr = arr / _weights(arr.shape, entry.get('decay'))
+    return arr.astype(np.dtype(entry['dtype']))
+
+def save_snap(file, params, fmt='float32', codec=None, decay=None):
+    """ header + contiguous blocks, aligned for memory mapping (raw float32/float16); written atomically;
+    decay of FFT params (if given) sets q8 precision by rendered magnitude """
+    if codec == 'zstd' and zstandard is None or codec == 'lz4' and lz4 is None:
+        print(' %s not installed, saving uncompressed' % codec); codec = None
+    tensors = params if isinstance(params, (list, tuple)) else [params]
+    arrays = [t.detach().cpu().float().contiguous().numpy() for t in tensors]
+    entries, blocks, offset = [], [], 0
+    for arr in arrays:
+        entry, data = _encode(arr, fmt, codec, decay)
+        entry['offset'] = offset
+        entries.append(entry)
+        blocks.append(data)
+        offset = _aligned(offset + len(data))
+    header = json.dumps({'version': 1, 'list': isinstance(params, (list, tuple)), 'tensors': entries}).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(header))
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for entry, data in zip(entries, blocks):
+            f.seek(start + entry['offset'])
+            f.write(data)
+    os.replace(tmp, file)
+
+def load_snap(file, device=None):
+    """ memory-mapped on cpu, copied to other devices; falls back to torch.load for other files """
+    if not is_snap(file):
+        return torch.load(file, map_location=device)
+    with open(file, 'rb') as f:
+        f.seek(len(MAGIC))
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size).decode('utf-8'))
+    start = _aligned(len(MAGIC) + 8 + size)
+    tensors = []
+    for entry in header['tensors']:
+        if entry.get('codec') is None and entry.get('format', 'float32') != 'q8': # raw
+            arr = np.memmap(file, dtype=np.dtype(entry.get('stored', entry['dtype'])), mode='c', offset=start + entry['offset'], shape=tuple(entry['shape']))
+            t = torch.from_numpy(arr)
+        else:
+            with open(file, 'rb') as f:
+                f.seek(start + entry['offset'])
+                t = torch.from_numpy(_decode(f.read(entry['nbytes']), entry))
+        if device is not None: t = t.to(device)
+        tensors.append(t.to(getattr(torch, entry['dtype'])))
+    return tensors if header['list'] is True else tensors[0]
+
+def keyframes(files, device=None, loop=True):
+    """ yields (params1, params2) for consecutive snapshots; every file is read once, the next one in background """
+    def load(k):
+        params = load_snap(files[k], device)
+        return params[0] if isinstance(params, list) else params
+    count = len(files) if loop is True else len(files) - 1
+    with ThreadPoolExecutor(1) as pool:
+        first = cur = load(0)
+        future = pool.submit(load, 1) if len(files) > 1 else None
+        for k in range(count):
+            if k + 1 < len(files):
+                nxt = future.result()
+                future = pool.submit(load, k + 2) if k + 2 < len(files) else None
+            else: # loop back
+                nxt = first
+            yield cur, nxt
+            cur = nxt
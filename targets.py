@@ -0,0 +1,62 @@
+"""
+from targets import Targets
+
+targets = Targets(count) # batch members
+targets.add('txt', txt_enc, -1.) # [dim] shared, or [count,dim] per batch member
+targets.add('txt0', txt_enc0, 0.5)
+loss = targets(out_enc, [('diverse', 0.2, out_enc2)]) # [count,n,dim]
+print(targets.values())
+"""
+
+import torch
+import torch.nn.functional as F
+
+class Targets(object):
+    '''Similarity loss against fixed targets (texts, images, prompt lists),
+    stacked & normalized once: all terms of a step in a single matmul, per-term values kept for logging
+    '''
+    def __init__(self, count=1):
+        self.count = count
+        self.names, self.embs, self.weights = [], [], []
+        self.matrix = None
+        self.reset()
+
+    def add(self, name, emb, weight=1.):
+        self.names.append(name)
+        self.embs.append(emb.detach().reshape(-1, emb.shape[-1]))
+        self.weights.append(weight)
+        self.matrix = None
+
+    def _stack(self, like): # [count,terms,dim]
+        embs = [e.to(like.device, like.dtype).expand(self.count, -1) for e in self.embs]
+        self.matrix = F.normalize(torch.stack(embs, 1), dim=-1)
+        self.wvec = torch.tensor(self.weights, device=like.device, dtype=like.dtype)
+
+    def reset(self): # per step
+        self.sums, self.pairs, self.n = 0., {}, 0
+
+    def __call__(self, enc, pairs=()):
+        """ enc [count,n,dim] -> weighted sum of cosine similarities, averaged over samples, summed over batch members;
+        pairs = [(name, weight, other [count,n,dim])] for per-sample terms (diversity, previous step, etc.) """
+        enc = F.normalize(enc, dim=-1)
+        n = enc.shape[1]
+        self.n += n
+        loss = 0
+        if len(self.names) > 0:
+            if self.matrix is None: self._stack(enc)
+            sims = torch.matmul(enc, self.matrix.transpose(1, 2)).mean(1).sum(0) # [terms]
+            loss = (sims * self.wvec).sum()
+            self.sums = self.sums + sims.detach() * n
+        for name, weight, other in pairs:
+            sim = (enc * F.normalize(other, dim=-1)).sum(-1).mean(-1).sum()
+            loss = loss + weight * sim
+            self.pairs[name] = self.pairs.get(name, 0.) + sim.detach() * n
+        return loss
+
+    def values(self): # mean similarities since reset, as floats (syncs the device)
+        if self.n == 0: return {}
+        vals = {}
+        if len(self.names) > 0 and torch.is_tensor(self.sums):
+            vals.update(zip(self.names, (self.sums / self.n).tolist()))
+        vals.update({k: float(v) / self.n for k, v in self.pairs.items()})
+        return vals
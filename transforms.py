@@ -1,14 +1,21 @@
 # Copyright 2020 The Lucent Authors. All Rights Reserved.
 # http://www.apache.org/licenses/LICENSE-2.0
 
+import math
 import torch
 import torch.nn.functional as F
-from torchvision import transforms
 import numpy as np
-import kornia
-import kornia.geometry.transform as K
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+_rotation_api = None
+def _rotation(): # kornia is imported on first use; its API moved between versions
+    global _rotation_api
+    if _rotation_api is None:
+        import kornia
+        try:
+            _rotation_api = kornia.geometry.transform.get_rotation_matrix2d, kornia.geometry.transform.warp_affine
+        except AttributeError:
+            _rotation_api = kornia.get_rotation_matrix2d, kornia.warp_affine
+    return _rotation_api
 
 def random_elastic():
     def inner(x):
@@ -16,7 +23,8 @@ def random_elastic():
         k = np.random.randint(8,64) * 2 + 1 # 63
         s = k / (np.random.rand()+2.) # 2-3 times less than k
         # s = float(np.random.randint(8,64)) # 32
-        noise = torch.zeros([1, 2, x.shape[2], x.shape[3]]).cuda()
+        noise = torch.zeros([x.shape[0], 2, x.shape[2], x.shape[3]], device=x.device)
+        import kornia.geometry.transform as K
         return K.elastic_transform2d(x, noise, (k,k), (s,s), tuple(a))
     return inner
 
@@ -25,7 +33,8 @@ def jitter(d):
     def inner(image_t):
         dx = np.random.choice(d)
         dy = np.random.choice(d)
-        return K.translate(image_t, torch.tensor([[dx, dy]]).float().to(device))
+        import kornia.geometry.transform as K
+        return K.translate(image_t, torch.tensor([[dx, dy]]).float().to(image_t.device))
     return inner
 
 def pad(w, mode="reflect", constant_value=0.5):
@@ -57,13 +66,9 @@ def random_rotate(angles, units="degrees"):
         center = torch.ones(b, 2)
         center[..., 0] = (image_t.shape[3] - 1) / 2
         center[..., 1] = (image_t.shape[2] - 1) / 2
-        try:
-            M = kornia.geometry.transform.get_rotation_matrix2d(center, angle, scale).to(device)
-            rotated_image = kornia.geometry.transform.warp_affine(image_t.float(), M, dsize=(h, w))
-        except:
-            M = kornia.get_rotation_matrix2d(center, angle, scale).to(device)
-            rotated_image = kornia.warp_affine(image_t.float(), M, dsize=(h, w))
-        return rotated_image
+        rotation_matrix, warp_affine = _rotation()
+        M = rotation_matrix(center, angle, scale).to(image_t.device)
+        return warp_affine(image_t.float(), M, dsize=(h, w))
     return inner
 
 def compose(transforms):
@@ -83,14 +88,86 @@ def _rads2angle(angle, units):
         angle = angle * 180.0 / np.pi
     return angle
 
-def normalize():
+class Normalize(object):
+    '''Normalization of image batches [b,c,h,w] at once, mean/std buffers kept per device & dtype
+    '''
+    def __init__(self, mean, std, inplace=False):
+        self.mean, self.std, self.inplace = mean, std, inplace
+        self.buffers = {}
+
+    def _buffers(self, x):
+        key = (str(x.device), x.dtype)
+        if key not in self.buffers:
+            self.buffers[key] = [torch.tensor(v, device=x.device, dtype=x.dtype).reshape(1,-1,1,1) for v in [self.mean, self.std]]
+        return self.buffers[key]
+
+    def __call__(self, x):
+        mean, std = self._buffers(x)
+        if self.inplace is True: # for fresh tensors only, e.g. cutouts
+            return x.sub_(mean).div_(std)
+        return (x - mean) / std
+
+def normalize(inplace=False):
     # ImageNet normalization for torchvision models
     # see https://pytorch.org/docs/stable/torchvision/models.html
-    # normal = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    normal = transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-    def inner(image_t):
-        return torch.stack([normal(t) for t in image_t])
-    return inner
+    # return Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], inplace)
+    # CLIP normalization
+    return Normalize([0.48145466, 0.4578275, 0.40821073], [0.26862954, 0.26130258, 0.27577711], inplace)
+
+class Augment(object):
+    '''Pad, rotate, scale, jitter, erase and elastic warp of cutouts, random per cutout,
+    composed into one sampling grid; slice_imgs fuses it with cropping in a single resample
+    '''
+    def __init__(self, pad=0, angles=None, scales=None, jitter=0, erase=0., elastic=0., fill=0.5, norm=True):
+        self.pad, self.jitter, self.erase, self.elastic, self.fill = pad, jitter, erase, elastic, fill
+        self.angles = None if angles is None else torch.tensor(angles, dtype=torch.float32) * math.pi / 180.
+        self.scales = None if scales is None else torch.tensor(scales, dtype=torch.float32)
+        self.norm = normalize(inplace=True) if norm is True else None
+
+    def _choice(self, values, n):
+        return values[torch.randint(len(values), (n,))]
+
+    def grid(self, theta, size):
+        """ sampling grid [n,s,s,2] for cutouts with crop thetas [n,2,3] in the source image + masks to apply after """
+        n, S, device = theta.shape[0], size + 2 * self.pad, theta.device
+        # output -> crop coords: undo jitter, rotation & scale around the center, then padding
+        M = torch.eye(2).repeat(n, 1, 1)
+        if self.angles is not None:
+            a = self._choice(self.angles, n)
+            M = torch.stack([torch.stack([a.cos(), a.sin()], -1), torch.stack([-a.sin(), a.cos()], -1)], 1)
+        if self.scales is not None:
+            M = M / self._choice(self.scales, n)[:, None, None]
+        jit = torch.randint(self.jitter, (n, 2)).float() if self.jitter > 1 else torch.zeros(n, 2)
+        A = torch.cat([M * (S-1) / (size-1), -2. / (size-1) * (M @ jit[..., None])], 2)
+        u = F.affine_grid(A.to(device, theta.dtype), [n, 1, S, S], align_corners=True)
+        if self.elastic > 0: # smooth random displacement, in pixels
+            noise = torch.randn(n, 2, max(2, S // 32), max(2, S // 32)).to(device, theta.dtype)
+            disp = F.interpolate(noise, (S, S), mode='bicubic', align_corners=True).permute(0,2,3,1)
+            u = u + disp * self.elastic * 2. / (size-1)
+        masks = [(u.abs() <= 1).all(-1)] # inside the crop, rest is padding
+        if self.erase > 0: # random rectangles, as in RandomErasing
+            area = S * S * (0.02 + 0.31 * torch.rand(n))
+            ratio = torch.exp(math.log(0.3) + math.log(3.3/0.3) * torch.rand(n))
+            eh, ew = (area * ratio).sqrt().clamp(max=S), (area / ratio).sqrt().clamp(max=S)
+            y0, x0 = torch.rand(n) * (S - eh), torch.rand(n) * (S - ew)
+            box = torch.stack([y0, y0 + eh, x0, x0 + ew], 1).to(device)[:, :, None, None] # [n,4,1,1]
+            yy, xx = torch.arange(S, device=device).float()[:, None], torch.arange(S, device=device).float()[None, :]
+            erased = (yy >= box[:, 0]) & (yy < box[:, 1]) & (xx >= box[:, 2]) & (xx < box[:, 3])
+            masks.append(~(erased & (torch.rand(n) < self.erase).to(device)[:, None, None]))
+        grid = torch.einsum('nhwj,nij->nhwi', u, theta[:, :, :2]) + theta[:, None, None, :, 2]
+        return grid, masks
+
+    def post(self, cuts, masks):
+        masks = [m[:, None] for m in masks]
+        cuts = torch.where(masks[0], cuts, torch.full_like(cuts, self.fill))
+        if len(masks) > 1: cuts = cuts * masks[1]
+        return cuts if self.norm is None else self.norm(cuts)
+
+    def __call__(self, x): # on ready cutouts
+        theta = torch.eye(2, 3, device=x.device, dtype=x.dtype).repeat(x.shape[0], 1, 1)
+        grid, masks = self.grid(theta, x.shape[-1])
+        cuts = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=True)
+        return self.post(cuts, masks)
 
 def preprocess_inceptionv1():
     # Original Tensorflow's InceptionV1 model takes in [-117, 138]
@@ -128,23 +205,7 @@ transforms_openai = compose([
 
 # my compos
 
-# my compos
-
-transforms_elastic = compose([
-    pad(4, mode="constant", constant_value=0.5),
-    transforms.RandomErasing(0.2),
-    random_rotate(list(range(-30, 30)) + 20 * [0]),
-    random_elastic(),
-    jitter(8),
-    normalize()
-])
+transforms_elastic = Augment(pad=4, angles=list(range(-30, 30)) + 20 * [0], jitter=8, erase=0.2, elastic=1.)
 
-transforms_custom = compose([
-    pad(4, mode="constant", constant_value=0.5),
-    # transforms.RandomPerspective(0.33, 0.2),
-    # transforms.RandomErasing(0.2),
-    random_rotate(list(range(-30, 30)) + 20 * [0]),
-    jitter(8),
-    normalize()
-])
+transforms_custom = Augment(pad=4, angles=list(range(-30, 30)) + 20 * [0], jitter=8)
 
@@ -1,17 +1,200 @@
 # coding: UTF-8
 import os
 import math
+import time
+import random
+import contextlib
+import queue
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from imageio import imread, imsave
-import cv2
-import scipy
 import numpy as np
-import matplotlib.pyplot as plt
-from kornia.filters.sobel import spatial_gradient
 
 import torch
 import torch.nn.functional as F
+# cv2, scipy, matplotlib, kornia & av are imported on first use, for faster startup
+
+class DevCtx():
+    """ Device/dtype context, shared by all entry points """
+    def __init__(self, name=None):
+        self.models = {}
+        self.resident = False # keep loaded models between jobs (server.py)
+        self.sampler, self.rss_peak = None, 0
+        self.set(name)
+
+    def set(self, name=None, threads=None, bf16=False):
+        if name is None or name == 'auto':
+            name = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(name)
+        self.cuda = self.device.type == 'cuda'
+        self.dtype = torch.float32 # parametrizations & scratch buffers
+        # bfloat16 autocast on cpu is available since torch 1.10
+        self.bf16 = bf16 is True and not self.cuda and hasattr(torch, 'autocast')
+        if not self.cuda and threads is not None and threads > 0:
+            torch.set_num_threads(threads)
+        self.buffers = {}
+        return self
+
+    def buffer(self, name, shape, dtype=None): # reusable scratch tensor, reallocated only on shape change
+        dtype = self.dtype if dtype is None else dtype
+        buf = self.buffers.get(name)
+        if buf is None or list(buf.shape) != list(shape) or buf.dtype != dtype:
+            buf = self.buffers[name] = torch.empty(shape, dtype=dtype, device=self.device)
+        return buf
+
+    def trim(self, budget=0): # free cached gpu memory only under pressure; budget in GB, 0 = 90% of the device
+        if not self.cuda: return
+        if torch.cuda.memory_reserved(self.device) > self.limit(budget):
+            torch.cuda.empty_cache()
+
+    def limit(self, budget=0): # memory budget in bytes; 0 = 90% of the gpu or 80% of ram
+        if budget > 0: return budget * 2**30
+        if self.cuda: return 0.9 * torch.cuda.get_device_properties(self.device).total_memory
+        try:
+            return 0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (AttributeError, ValueError, OSError): # not on windows
+            return float('inf')
+
+    def peak(self, reset=False): # peak memory in bytes since reset: allocated on gpu, resident on cpu (sampled)
+        if self.cuda:
+            if reset is True: torch.cuda.reset_peak_memory_stats(self.device)
+            return torch.cuda.max_memory_allocated(self.device)
+        if not os.path.isfile('/proc/self/statm'): # process peak only, can't be reset
+            try:
+                import resource
+                return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kb on linux
+            except ImportError:
+                return 0
+        if reset is True or self.sampler is None:
+            self.rss_peak = self.rss()
+        if self.sampler is None: # ru_maxrss is never reset, so poll the current rss instead
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+        return max(self.rss_peak, self.rss())
+
+    def rss(self): # current resident memory in bytes (linux)
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _sample(self):
+        while True:
+            self.rss_peak = max(self.rss_peak, self.rss())
+            time.sleep(0.002)
+
+    def sync(self):
+        if self.cuda: torch.cuda.synchronize(self.device)
+
+    def load(self, key, calc): # model loading, cached per device if resident
+        key = (*key, str(self.device), self.bf16)
+        if key in self.models:
+            return self.models[key]
+        model = calc()
+        if self.resident is True: self.models[key] = model
+        return model
+
+    def autocast(self):
+        if self.bf16:
+            return torch.autocast('cpu', dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def layout(self, x): # channels-last is faster for cpu convolutions
+        if not self.cuda and x.dim() == 4:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def model(self, model):
+        model = model.to(self.device)
+        if not self.cuda: model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def encode(self, model, img): # image encoding in device-specific layout & precision
+        with self.autocast():
+            return model.encode_image(self.layout(img)).float()
+
+dev = DevCtx()
+
+def autotune(probe, total, budget=0, step_time=0, start=8, verbose=True):
+    """ probe(n) runs forward & backward on n samples; finds the largest micro-batch within memory budget (GB),
+    then the micro-batch count for total samples per step, cutting total to fit step time (sec) if given """
+    limit, n, best, rate = dev.limit(budget), min(start, total), 0, None
+    probe(n) # warm-up
+    dev.sync()
+    prev = (0, dev.peak(reset=True)) # samples & memory before probing (model, params)
+    while True:
+        dev.peak(reset=True)
+        try:
+            dev.sync(); t0 = time.perf_counter()
+            probe(n)
+            dev.sync(); t = time.perf_counter() - t0
+        except RuntimeError as e: # oom
+            if 'out of memory' not in str(e): raise
+            if dev.cuda: torch.cuda.empty_cache()
+            break
+        mem = dev.peak()
+        if mem > limit: break
+        best, rate = n, t / n
+        if verbose is True: print(' autotune: %d samples, %.3fs, %.0f MB' % (n, t, mem / 2**20))
+        if n >= total or step_time > 0 and t > step_time: break
+        # predict the next peak from the growth so far, never probe over the limit (on cpu oom kills the process)
+        per = (mem - prev[1]) / (n - prev[0])
+        prev, n = (n, mem), min(n * 2, total)
+        if per > 0 and mem + per * (n - best) > limit:
+            n = best + int(0.9 * (limit - mem) / per)
+            if n <= best: break
+    if best == 0:
+        best, rate = max(1, n // 2), 0.
+        print(' autotune: %d samples exceed the memory budget, trying %d' % (n, best))
+    if step_time > 0 and rate > 0 and total * rate > step_time: # fewer samples, not slower steps
+        total = max(1, int(step_time / rate))
+    micro = math.ceil(total / best)
+    return total // micro, micro # per micro-batch, count
+
+def micro_encode(model, cuts, loss_fn, micro=1, count=1, pairs=1, stage=None):
+    """ encode cutouts [count * pairs * n, c,h,w] in micro-batches, backpropagating each one into the cutouts right away;
+    loss_fn(enc [count, pairs * k, dim], idx) is a mean over samples, so the summed (rescaled) chunk losses equal the full batch one;
+    pairs = 2 keeps the diversity halves aligned. returns loss value & gradient for the cutouts """
+    if stage is None: stage = lambda name: contextlib.nullcontext()
+    cuts_d = cuts.detach().requires_grad_()
+    views = cuts_d.reshape(count, pairs, -1, *cuts.shape[1:])
+    n = views.shape[2]
+    bounds = [n * k // micro for k in range(micro + 1)]
+    total = 0.
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        if e == s: continue
+        with stage('encode'):
+            enc = dev.encode(model, views[:, :, s:e].reshape(-1, *cuts.shape[1:]))
+            enc = enc.reshape(count, pairs * (e - s), enc.shape[-1])
+        with stage('loss'):
+            loss = loss_fn(enc, slice(s, e)) * (e - s) / n
+        with stage('backward'):
+            loss.backward()
+        total += loss.detach()
+        del enc, loss
+    return total, cuts_d.grad
+
+def recompute(model, on=True):
+    """ activation checkpointing in the image encoder: transformer blocks (ViT) or layers (ResNet) are recomputed in backward """
+    if isinstance(model, torch.jit.ScriptModule):
+        if on is True: print(' activation checkpointing is not available for jit models')
+        return
+    import inspect
+    from torch.utils.checkpoint import checkpoint
+    kw = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {} # torch >= 1.11
+    vis = model.visual
+    if hasattr(vis, 'transformer'):
+        blocks = list(vis.transformer.resblocks)
+    else:
+        blocks = [getattr(vis, 'layer%d' % k) for k in range(1, 5) if hasattr(vis, 'layer%d' % k)]
+    for block in blocks:
+        if not hasattr(block, 'forward_full'): # patched once, toggled by the flag (models may be shared between jobs)
+            if on is not True: continue
+            block.forward_full = block.forward
+            block.forward = lambda x, block=block: checkpoint(block.forward_full, x, **kw) if block.recompute and torch.is_grad_enabled() else block.forward_full(x)
+        block.recompute = on
 
 def plot_text(txt, size=224):
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(1,1), dpi=size)
     fontsize = size//len(txt) if len(txt) < 15 else 8
     plt.text(0.5, 0.5, txt, fontsize=fontsize, ha='center', va='center', wrap=True)
@@ -37,7 +220,7 @@ def file_list(path, ext=None, subdir=None):
         if isinstance(ext, list):
             files = [f for f in files if os.path.splitext(f.lower())[1][1:] in ext]
         elif isinstance(ext, str):
-            files = [f for f in files if f.endswith(ext)]
+            files = [f for f in files if f.endswith('.' + ext.lstrip('.'))] # extension, not just suffix
         else:
             print(' Unknown extension/type for file list!')
     return sorted([f for f in files if os.path.isfile(f)])
@@ -66,6 +249,7 @@ def img_save(path, img, norm=True):
     imsave(path, img)
     
 def cvshow(img):
+    import cv2
     img = np.array(img)
     if img.shape[0] > 720 or img.shape[1] > 1280:
         x_ = 1280 / img.shape[1]
@@ -83,6 +267,185 @@ def checkout(img, fname=None, verbose=False):
         img = np.clip(img*255, 0, 255).astype(np.uint8)
         imsave(fname, img)
 
+class FrameWriter(object):
+    '''Saves frames in the background: device->host copies via pinned buffers,
+    jpg encoding in a thread pool, in-order feeding of video sinks,
+    blocking when too many frames are queued
+    '''
+    def __init__(self, workers=2, maxsize=8, verbose=False):
+        self.pool = ThreadPoolExecutor(workers)
+        self.slots = threading.Semaphore(maxsize)
+        self.lock = threading.Lock() # for preview
+        self.buffers = {}
+        self.error = None
+        self.verbose = verbose
+        self.queue = queue.Queue()
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def _buffer(self, img):
+        if img.device.type != 'cuda':
+            return img, None
+        with self.lock:
+            free = self.buffers.setdefault(tuple(img.shape), [])
+            buf = free.pop() if len(free) > 0 else torch.empty(img.shape, dtype=img.dtype, pin_memory=True)
+        buf.copy_(img, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        return buf, event
+
+    def _write(self, buf, event, fname, show):
+        if event is not None: event.synchronize()
+        img = buf.numpy()
+        if self.verbose is True and show is True:
+            with self.lock: cvshow(img)
+        if fname is not None:
+            imsave(fname, img)
+        return img
+
+    def _feed(self): # keeps the frames order
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            future, buf, event, video = item
+            try:
+                img = future.result()
+                if video is not None:
+                    video.write(img)
+            except Exception as e:
+                if self.error is None: self.error = e
+            if event is not None:
+                with self.lock: self.buffers[tuple(buf.shape)].append(buf)
+            self.slots.release()
+
+    def put(self, img, fname=None, video=None, show=True):
+        # img = torch tensor [3,h,w] in 0..1 range; converted to uint8 on its device
+        if self.error is not None: raise self.error
+        with torch.no_grad():
+            img = torch.clip(img.detach()*255, 0, 255).to(torch.uint8).permute(1,2,0)
+        self.slots.acquire() # backpressure
+        buf, event = self._buffer(img)
+        future = self.pool.submit(self._write, buf, event, fname, show)
+        self.queue.put((future, buf, event, video))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.feeder.join()
+        self.pool.shutdown(wait=True)
+        if self.error is not None: raise self.error
+
+class VideoWriter(object):
+    '''Streams rgb frames into a video file: with PyAV (if installed) or ffmpeg process
+    '''
+    def __init__(self, fname, fps=25):
+        self.fname = fname
+        self.fps = fps
+        self.container = None
+        self.proc = None
+
+    def _open(self, h, w):
+        try: # faster video encoding, if available
+            import av
+            self.av = av
+        except ImportError:
+            self.av = None
+        if self.av is not None:
+            self.container = av.open(self.fname, mode='w')
+            self.stream = self.container.add_stream('libx264', rate=self.fps)
+            self.stream.width, self.stream.height = w, h
+            self.stream.pix_fmt = 'yuv420p'
+        else:
+            cmd = ['ffmpeg', '-v', 'warning', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (w, h), '-r', str(self.fps), 
+                   '-i', '-', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', self.fname]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, img): # uint8 [h,w,3]
+        img = np.ascontiguousarray(img[:img.shape[0]//2*2, :img.shape[1]//2*2]) # yuv420 needs even size
+        if self.container is None and self.proc is None:
+            self._open(*img.shape[:2])
+        if self.container is not None:
+            frame = self.av.VideoFrame.from_ndarray(img, format='rgb24')
+            for packet in self.stream.encode(frame):
+                self.container.mux(packet)
+        else:
+            self.proc.stdin.write(img.tobytes())
+
+    def close(self):
+        if self.container is not None:
+            for packet in self.stream.encode(): # flush
+                self.container.mux(packet)
+            self.container.close()
+        elif self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+def save_ckpt(path, state):
+    # atomic write, with all random generators states
+    state['rng'] = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['rng']['cuda'] = torch.cuda.get_rng_state_all()
+    tmp = path + '.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+def load_ckpt(path):
+    if not os.path.isfile(path): return None
+    try: # holds numpy rng state, not only tensors
+        state = torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError: # torch < 1.13
+        state = torch.load(path, map_location='cpu')
+    rng = state['rng']
+    torch.set_rng_state(rng['torch'])
+    np.random.set_state(rng['numpy'])
+    random.setstate(rng['random'])
+    if 'cuda' in rng and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng['cuda'])
+    return state
+
+class _Tiled(torch.autograd.Function):
+    '''Row strips of x processed one by one: fn(x[:,:,y0:y1], *args) = output rows.
+    Intermediates are not kept; backward recomputes the strips (if sparse, only those with nonzero gradient)
+    '''
+    @staticmethod
+    def forward(ctx, fn, tile, sparse, x, *args):
+        ctx.fn, ctx.tile, ctx.sparse = fn, tile, sparse
+        ctx.save_for_backward(x, *args)
+        return torch.cat([fn(x[:, :, y : y+tile], *args) for y in range(0, x.shape[2], tile)], 2)
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, *args = ctx.saved_tensors
+        args = [t.detach().requires_grad_(t.requires_grad) for t in args]
+        grad_x = torch.zeros_like(x) if ctx.needs_input_grad[3] else None
+        grad_args = [None] * len(args)
+        ys = range(0, x.shape[2], ctx.tile)
+        if ctx.sparse is True: # strips not sampled, checked with one sync
+            ys = [y for y, live in zip(ys, torch.stack([grad[:, :, y : y+ctx.tile].any() for y in ys]).tolist()) if live]
+        for y in ys:
+            g = grad[:, :, y : y+ctx.tile]
+            xs = x[:, :, y : y+ctx.tile].detach().requires_grad_(grad_x is not None)
+            with torch.enable_grad():
+                out = ctx.fn(xs, *args)
+            inputs = [t for t in [xs, *args] if t.requires_grad]
+            grads = iter(torch.autograd.grad(out, inputs, g, allow_unused=True))
+            if grad_x is not None:
+                gx = next(grads)
+                if gx is not None: grad_x[:, :, y : y+ctx.tile] = gx
+            for k, t in enumerate(args):
+                if not t.requires_grad: continue
+                gk = next(grads)
+                if gk is not None:
+                    grad_args[k] = gk if grad_args[k] is None else grad_args[k] + gk
+        return (None, None, None, grad_x, *grad_args)
+
+def tiled(fn, x, tile=0, *args, sparse=True):
+    """ fn(x, *args) computed over row strips of x [b,c,h,...] to bound memory; tile = strip height;
+    sparse = skip strips without gradient on backward (off for whole-image losses, which touch every strip) """
+    if tile <= 0 or tile >= x.shape[2]:
+        return fn(x, *args)
+    return _Tiled.apply(fn, tile, sparse, x, *args)
+
 def minmax(x, torch=True):
     if torch:
         mn = torch.min(x).detach().cpu().numpy()
@@ -133,45 +496,76 @@ def pad_up_to(x, size, type='centr'):
     return y
 
 def smoothstep(x, NN=1, xmin=0., xmax=1.):
+    from scipy.special import comb
     N = math.ceil(NN)
     x = np.clip((x - xmin) / (xmax - xmin), 0, 1)
     result = 0
     for n in range(0, N+1):
-         result += scipy.special.comb(N+n, n) * scipy.special.comb(2*N+1, N-n) * (-x)**n
+         result += comb(N+n, n) * comb(2*N+1, N-n) * (-x)**n
     result *= x**(N+1)
     if NN != N: result = (x + result) / 2
     return result
 
 def slerp(z1, z2, num_steps=None, x=None, smooth=0.5):
+    # x = float or array of steps; all of them are computed at once, concatenated along the batch dim
     z1_norm = z1.norm()
     z2_norm = z2.norm()
     z2_normal = z2 * (z1_norm / z2_norm)
-    vectors = []
     if num_steps is not None:
-        xs = [step / (num_steps - 1) for step in range(num_steps)]
+        xs = np.arange(num_steps) / (num_steps - 1)
     else:
-        xs = [x]
-    if smooth > 0: xs = [smoothstep(x, smooth) for x in xs]
-    for x in xs:
-        interplain = z1 + (z2 - z1) * x
-        interp = z1 + (z2_normal - z1) * x
-        interp_norm = interp.norm()
-        if interp_norm != 0:
-            interpol_normal = interplain * (z1_norm / interp_norm)
-        vectors.append(interpol_normal)
-    return torch.cat(vectors)
+        xs = np.atleast_1d(np.asarray(x, dtype=np.float32))
+    if smooth > 0: xs = smoothstep(xs, smooth)
+    xs = torch.tensor(xs, dtype=z1.dtype, device=z1.device).reshape(-1, *[1] * z1.dim())
+    interplain = z1 + (z2 - z1) * xs
+    interp = z1 + (z2_normal - z1) * xs
+    interp_norm = interp.flatten(1).norm(dim=1).reshape(xs.shape)
+    interpol_normal = torch.where(interp_norm != 0, interplain * (z1_norm / interp_norm), interplain)
+    return interpol_normal.flatten(0, 1)
+
+# grid_sample supports bicubic since torch 1.8
+_interp = 'bicubic' if tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (1,8) else 'bilinear'
+
+def crop_theta(offx, offy, csize, shape):
+    """ affine matrices [N,2,3], mapping the output grid onto square pixel boxes of the image """
+    h, w = [float(s) for s in shape]
+    csize = csize.float() - 1
+    theta = torch.zeros(len(csize), 2, 3)
+    theta[:,0,0] = csize / (w-1)
+    theta[:,1,1] = csize / (h-1)
+    theta[:,0,2] = (2 * offx.float() + csize) / (w-1) - 1
+    theta[:,1,2] = (2 * offy.float() + csize) / (h-1) - 1
+    return theta
+
+def resample(img, theta, size, augment=None):
+    """ sample all crops at once with a single grid_sample call; theta holds N crops per batch member
+    augment (as transforms.Augment) adds its warps to the same sampling grid """
+    b, c = img.shape[:2]
+    count = theta.shape[0] // b
+    theta = theta.to(img.device, img.dtype)
+    if augment is None:
+        grid = F.affine_grid(theta, [b * count, c, size, size], align_corners=True) # [b*N,size,size,2]
+    else:
+        grid, masks = augment.grid(theta, size)
+        size = grid.shape[1]
+    grid = grid.reshape(b, count * size, size, 2)
+    cuts = F.grid_sample(img, grid, mode=_interp, padding_mode='border', align_corners=True) # [b,c,N*size,size]
+    cuts = cuts.reshape(b, c, count, size, size).transpose(1, 2).reshape(b * count, c, size, size)
+    return cuts if augment is None else augment.post(cuts, masks)
 
 def slice_imgs(imgs, count, size=224, transform=None, align='uniform', macro=0.):
     def map(x, a, b):
         return x * (b-a) + a
 
-    rnd_size = torch.rand(count)
+    # independent crops for every batch member
+    num = count * max([img.shape[0] for img in imgs])
+    rnd_size = torch.rand(num)
     if align == 'central': # normal around center
-        rnd_offx = torch.clip(torch.randn(count) * 0.2 + 0.5, 0., 1.)
-        rnd_offy = torch.clip(torch.randn(count) * 0.2 + 0.5, 0., 1.)
+        rnd_offx = torch.clip(torch.randn(num) * 0.2 + 0.5, 0., 1.)
+        rnd_offy = torch.clip(torch.randn(num) * 0.2 + 0.5, 0., 1.)
     else: # uniform
-        rnd_offx = torch.rand(count)
-        rnd_offy = torch.rand(count)
+        rnd_offx = torch.rand(num)
+        rnd_offy = torch.rand(num)
     
     sz = [img.shape[2:] for img in imgs]
     sz_max = [torch.min(torch.tensor(s)) for s in sz]
@@ -181,29 +575,30 @@ def slice_imgs(imgs, count, size=224, transform=None, align='uniform', macro=0.)
 
     sliced = []
     for i, img in enumerate(imgs):
-        cuts = []
-        sz_max_i = sz_max[i]
-        for c in range(count):
-            sz_min_i = 0.9*sz_max[i] if torch.rand(1) < macro else size
-            csize = map(rnd_size[c], sz_min_i, sz_max_i).int()
-            offsetx = map(rnd_offx[c], 0, sz[i][1] - csize).int()
-            offsety = map(rnd_offy[c], 0, sz[i][0] - csize).int()
-            cut = img[:, :, offsety:offsety + csize, offsetx:offsetx + csize]
-            cut = F.interpolate(cut, (size,size), mode='bicubic', align_corners=True) # bilinear
+        n = count * img.shape[0]
+        sz_min = torch.where(torch.rand(n) < macro, 0.9 * sz_max[i].float(), torch.tensor(float(size)))
+        csize = map(rnd_size[:n], sz_min, sz_max[i]).int()
+        offsetx = map(rnd_offx[:n], 0, sz[i][1] - csize).int()
+        offsety = map(rnd_offy[:n], 0, sz[i][0] - csize).int()
+        theta = crop_theta(offsetx, offsety, csize, sz[i])
+        if hasattr(transform, 'grid'): # fused augmentation
+            cuts = resample(img, theta, size, transform)
+        else:
+            cuts = resample(img, theta, size)
             if transform is not None: 
-                cut = transform(cut)
-            cuts.append(cut)
-        sliced.append(torch.cat(cuts, 0))
+                cuts = transform(cuts)
+        sliced.append(cuts)
     return sliced
 
 def derivat(img, mode='sobel'):
     if mode == 'scharr': 
         # https://en.wikipedia.org/wiki/Sobel_operator#Alternative_operators
         k_scharr = torch.Tensor([[[-0.183,0.,0.183], [-0.634,0.,0.634], [-0.183,0.,0.183]], [[-0.183,-0.634,-0.183], [0.,0.,0.], [0.183,0.634,0.183]]])
-        k_scharr = k_scharr.unsqueeze(1).tile((1,3,1,1)).cuda()
+        k_scharr = k_scharr.unsqueeze(1).tile((1,3,1,1)).to(img.device)
         return 0.2 * torch.mean(torch.abs(F.conv2d(img, k_scharr)))
     elif mode == 'sobel':
         # https://kornia.readthedocs.io/en/latest/filters.html#edge-detection
+        from kornia.filters.sobel import spatial_gradient
         return torch.mean(torch.abs(spatial_gradient(img)))
     else: # trivial hack
         dx = torch.mean(torch.abs(img[:,:,:,1:] - img[:,:,:,:-1]))